@@ -6,10 +6,65 @@ import sys  # For printing to standard error output
 import os  # For interacting with the operating system (e.g., creating folders and files)
 import struct  # For packing and unpacking the header
 import subprocess  # For running commands in the terminal
+import mmap  # For reading the file to send lazily, without loading it into memory
+import queue  # For the bounded queue between the receiver and the disk writer
+import threading  # For writing the received file to disk in the background
+import select  # For waiting until the socket is ready
+import selectors  # For waiting for the socket and the timers in one event loop (epoll on Linux)
+import errno  # For checking the errors from the batch system calls
+import ctypes  # For calling sendmmsg and recvmmsg from the C library
+import ctypes.util  # For finding the C library
+import collections  # For the queue of packets split from a coalesced (GRO) buffer
+import heapq  # For the retransmission timers of selective repeat
+import math  # For rounding up the number of parity packets
 
 # Default values
 formatting_line = "-" * 45  # Formatting line = -----------------------------
 max_filename_length = 32  # Maximum length of the file
+header_length = 12  # Length of the DRTP header in bytes
+receive_buffer_size = 2048  # Size of the receive buffer, larger than the largest DRTP packet (1472 bytes)
+max_advertised_window = 2 ** 16 - 1  # Largest window that fits in the 16 bit window field
+max_window_scale = 14  # Largest window scale shift, the window can be up to 1 GB, based on RFC 7323
+# The size of the socket receive buffer the server asks for, the kernel can give less. Half of it is advertised as the
+# window, the other half is used by the kernel for the bookkeeping of each datagram
+socket_receive_buffer = 4 * 1024 * 1024
+# UDP segmentation offload (GSO) and receive offload (GRO) socket options, from <linux/udp.h>
+UDP_SEGMENT = getattr(socket, "UDP_SEGMENT", 103)
+UDP_GRO = getattr(socket, "UDP_GRO", 104)
+max_segments = 64  # Largest number of datagrams the kernel splits one GSO buffer into (UDP_MAX_SEGMENTS)
+max_udp_payload = 65507  # Largest UDP payload, the limit for a GSO buffer and a GRO buffer
+# The buffers of a batch are allocated up front, so a batch holds at most this many packets to send and to receive,
+# however large the window is. A larger window is sent as several batches
+batch_limit = 1024
+receive_batch_size = 64
+# Limits for the retransmission timeout in seconds, and the clock granularity, based on RFC 6298
+min_rto = 0.05
+max_rto = 10
+clock_granularity = 0.001
+# The SYN and the FIN are sent again with a doubled timeout when they are not answered, this many times before giving
+# up. The first SYN has no RTT to go by, its timeout is the initial RTO of RFC 6298
+syn_timeout = 1
+max_control_retries = 6
+# The server answers FINs that are sent again after its FIN ACK was lost, until none has come for this many seconds
+fin_linger_time = 1
+# The congestion window at the start, in packets, based on RFC 5681
+initial_congestion_window = 2
+# Limits for the number of packets a delay based sender keeps queued in the network, based on TCP Vegas
+delay_alpha = 2
+delay_beta = 4
+# Pacing: the packets a token bucket can send back to back, how much faster than one window per RTT to pace, and the
+# gaps that are waited for by checking the clock, since the selector only waits whole milliseconds
+pacing_burst = 2
+pacing_gain = 1.25
+pacing_spin_time = 0.001
+# Delayed acks: the GBN and SR servers send one ack for this many packets in order, or when the first of them has
+# waited this many seconds
+default_ack_every = 2
+default_ack_delay = 0.005
+# The memory mapped writer has the data written back to disk in a thread of its own, each time this many bytes have
+# arrived. The window shrinks when more than max_unflushed bytes wait for the disk, so a slow disk slows the sender
+flush_chunk_size = 4 * 1024 * 1024
+max_unflushed = 32 * 1024 * 1024
 default_server_save_path = "received_files"  # Path to the folder where received files are stored
 default_ip = "127.0.0.1"
 default_port = 8088
@@ -140,6 +195,69 @@ def pretty_flags(flags):
 # From https://docs.python.org/3/library/struct.html
 DRTP_struct = struct.Struct("!IIHH")
 
+# The sequence and acknowledgment numbers are counted modulo 2^32 in the header. Inside the program they are
+# extended to unlimited integers (byte offsets that do not wrap), so files larger than 4 GB can be sent, and a
+# transfer can cross the wrap point. Only the lowest 32 bits are sent, see unwrap_sequence for the other way
+sequence_modulus = 2 ** 32
+sequence_mask = sequence_modulus - 1
+
+# sendmsg is used for sending the header and the data without joining them, if the platform has it
+has_sendmsg = hasattr(socket.socket, "sendmsg")
+# recvmsg_into is used for receiving the data straight into the output file, if the platform has it
+has_recvmsg_into = hasattr(socket.socket, "recvmsg_into")
+
+# Define the structure of the options in the SYN and the SYN-ACK packets, they follow the header as type-length-value
+# (TLV) entries. The client offers the options it supports, and the server answers with the options it accepts, an
+# option that is not in the SYN-ACK is not used. Options with a type that is not known are skipped, so a peer can
+# send new options to a peer that does not know them yet
+# B = 8 bits
+# Type:8 bits, Length:8 bits, then the value of Length bytes
+option_struct = struct.Struct("!BB")
+option_reliability = 1  # The reliability mode of the client, the index in reliability_modes (B)
+option_window = 2  # The largest window of the client in packets (I)
+option_mss = 3  # The largest data in a packet (H)
+option_window_scale = 4  # The window field is scaled, the number of bits it is shifted to the left (B)
+option_sack = 5  # Selective acknowledgements (SACK) are supported, no value
+option_timestamps = 6  # Reserved for timestamps in the packets, not offered yet
+option_compression = 7  # Reserved for compressed data, not offered yet
+option_file_size = 8  # The size of the file to send, the server can preallocate it (Q)
+option_fec = 9  # Parity packets for forward error correction (FEC) are understood, no value
+option_ack_delay = 10  # The longest time the server holds back an ack, in milliseconds (I)
+reliability_modes = ["stop_and_wait", "gbn", "sr", "nak"]
+
+# Define the structures of the values of the options
+# B = 8 bits, H = 16 bits, I = 32 bits, Q = 64 bits
+option_byte_struct = struct.Struct("!B")
+option_short_struct = struct.Struct("!H")
+option_int_struct = struct.Struct("!I")
+option_long_struct = struct.Struct("!Q")
+# The largest data in a packet, a 1472 byte packet fits in a 1500 byte Ethernet frame with the IP and UDP headers.
+# A larger MSS is accepted up to the size of the receive buffer
+default_mss = 1460
+max_mss = receive_buffer_size - header_length
+# The largest window in packets that -w takes. The server can not advertise more than about 1 GB with the largest
+# window scale, so a larger window would never be used
+max_window = (max_advertised_window << max_window_scale) // default_mss
+
+# Define the structure of the SACK data in an ack packet. It has the cumulative ack (all bytes before it are received)
+# and blocks with the start and the end of the ranges received after it
+# I = 32 bits
+# Cumulative ack:32 bits, then for each block: Start:32 bits, End:32 bits
+SACK_struct = struct.Struct("!I")
+SACK_block_struct = struct.Struct("!II")
+max_sack_blocks = 16  # The number of blocks that are sent in one ack, the blocks closest to the cumulative ack are sent
+# In the NAK mode the blocks are the ranges that are missing. A data packet with the poll flag asks the server for a
+# checkpoint at once, the flag is above the four flags of the header
+flag_poll = 1 << 4
+# A parity packet for forward error correction (FEC) has the parity flag. Its sequence number is the sequence number of
+# the first packet of the block, its window field is the XOR of the lengths of the packets it covers, and its ack field
+# holds the number of data packets in the block (16 bits), the number of parity packets (8 bits) and its index (8 bits).
+# Parity packet j covers the packets j, j + k, j + 2k ... of the block, so k packets in a row can be rebuilt
+flag_parity = 1 << 5
+max_fec_block = 255  # The largest block, in data packets
+max_fec_parity = 8  # The most parity packets per block
+fec_redundancy = 2  # The adaptive FEC sends this many times the parity packets the measured loss needs
+
 
 # Description:
 #   Function for creating a header with the right format with fixed bit sizes
@@ -152,7 +270,7 @@ DRTP_struct = struct.Struct("!IIHH")
 #   Returns the header as a byte string, ready to be sent
 def encode_header(sequence_number, acknowledgment_number, flags, window):
     # Sequence Number:32 bits, Acknowledgment Number:32bits, Flags:16bits, Window:16bits
-    return DRTP_struct.pack(sequence_number, acknowledgment_number, flags, window)
+    return DRTP_struct.pack(sequence_number & sequence_mask, acknowledgment_number & sequence_mask, flags, window)
 
 
 # Description:
@@ -165,6 +283,20 @@ def decode_header(header):
     return DRTP_struct.unpack(header)
 
 
+# Description:
+#   Function for extending a 32 bit sequence number from the header to the full sequence number, with serial number
+#   arithmetic based on RFC 1982. The result is the number with the same lowest 32 bits that is closest to the
+#   reference, a number we know is near (like the next sequence number we expect). It works as long as less than
+#   2 GB are in flight, and numbers that are already extended are returned as they are
+# Parameters:
+#   number: holds the sequence or acknowledgment number from the header
+#   reference: holds the full sequence number to compare with
+# Returns:
+#   Returns the full sequence number
+def unwrap_sequence(number, reference):
+    return reference + ((number - reference + sequence_modulus // 2) & sequence_mask) - sequence_modulus // 2
+
+
 # Description:
 #   Function for stripping the header from the packet
 # Parameters:
@@ -179,28 +311,925 @@ def strip_packet(raw_data):
 
 
 # Description:
-#   Function for creating a packet
+#   Function for finding the window scale shift, so the largest window we advertise fits in the window field
+# Parameters:
+#   max_window: holds the largest window in bytes
+# Returns:
+#   Returns the shift, from 0 up to max_window_scale
+def window_scale_for(max_window):
+    window_scale = 0
+    while (max_window >> window_scale) > max_advertised_window and window_scale < max_window_scale:
+        window_scale += 1
+    return window_scale
+
+
+# Description:
+#   Function for creating the SACK data of an ack packet
+# Parameters:
+#   cumulative_ack: holds the sequence number of the next byte in order
+#   blocks: holds the ranges received after it, as a list of [start, end]
+# Returns:
+#   Returns the SACK data as a byte string
+def encode_sack(cumulative_ack, blocks):
+    return SACK_struct.pack(cumulative_ack & sequence_mask) + b"".join(
+        SACK_block_struct.pack(start & sequence_mask, end & sequence_mask) for start, end in blocks)
+
+
+# Description:
+#   Function for reading the SACK data of an ack packet
+# Parameters:
+#   data: holds the data of the ack packet
+#   reference: holds the full sequence number the numbers are extended from, see unwrap_sequence
+# Returns:
+#   Returns the cumulative ack and a list with the (start, end) of each block, or None if there is no SACK data
+def decode_sack(data, reference):
+    if len(data) < SACK_struct.size:
+        return None
+    cumulative_ack = unwrap_sequence(SACK_struct.unpack_from(data)[0], reference)
+    blocks = []
+    for offset in range(SACK_struct.size, len(data) - SACK_block_struct.size + 1, SACK_block_struct.size):
+        start, end = SACK_block_struct.unpack_from(data, offset)
+        blocks.append((unwrap_sequence(start, reference), unwrap_sequence(end, reference)))
+    return cumulative_ack, blocks
+
+
+# Description:
+#   Function for creating the options of a SYN or a SYN-ACK packet
+# Parameters:
+#   options: holds a dictionary with the type of each option and its value as a byte string
+# Returns:
+#   Returns the options as a byte string of type-length-value entries
+def encode_options(options):
+    return b"".join(option_struct.pack(option_type, len(value)) + value for option_type, value in options.items())
+
+
+# Description:
+#   Function for reading the options of a SYN or a SYN-ACK packet. Options of every type are returned, the ones that
+#   are not known are never looked up. The options stop at an entry that is cut off
 # Parameters:
+#   data: holds the data of the packet
+# Returns:
+#   Returns a dictionary with the type of each option and its value as a byte string
+def decode_options(data):
+    options = {}
+    offset = 0
+    while offset + option_struct.size <= len(data):
+        option_type, length = option_struct.unpack_from(data, offset)
+        offset += option_struct.size
+        if offset + length > len(data):
+            break
+        options[option_type] = bytes(data[offset:offset + length])
+        offset += length
+    return options
+
+
+# Description:
+#   Function for reading the value of an option
+# Parameters:
+#   options: holds the options from decode_options
+#   option_type: holds the type of the option
+#   value_struct: holds the structure of the value
+#   default: holds the value to use if the option is not there, or if its value has the wrong length
+# Returns:
+#   Returns the value of the option, or the default
+def option_value(options, option_type, value_struct, default=None):
+    value = options.get(option_type)
+    if value is None or len(value) != value_struct.size:
+        return default
+    return value_struct.unpack(value)[0]
+
+
+# Description:
+#   Function for packing a header into a preallocated buffer, instead of creating a new byte string for every packet
+# Parameters:
+#   header_buffer: holds the buffer to pack the header into (a bytearray of 12 bytes)
 #   sequence_number: holds the sequence number
 #   acknowledgment_number: holds the acknowledgment number
-#   flags: holds the flags
+#   flags: holds the flags set
 #   window: holds the window
+# Returns:
+#   Returns nothing, the header is written into header_buffer
+def encode_header_into(header_buffer, sequence_number, acknowledgment_number, flags, window):
+    DRTP_struct.pack_into(header_buffer, 0, sequence_number & sequence_mask, acknowledgment_number & sequence_mask,
+                          flags, window)
+
+
+# Description:
+#   Function for sending a packet without joining the header and the data. The header and the data are given to the
+#   kernel as two buffers with sendmsg (scatter-gather), so the data (a memoryview into the file) is never copied.
+#   Retransmissions send the same header buffer and data again
+# Parameters:
+#   sock: holds the socket
+#   address: holds the address to send to
+#   header_buffer: holds the packed header
 #   data: holds the data
 # Returns:
-#   Returns the packet as a byte string
-def create_packet(sequence_number, acknowledgment_number, flags, window, data):
-    return encode_header(sequence_number, acknowledgment_number, flags, window) + data
+#   Returns nothing, it sends the packet
+def send_packet(sock, address, header_buffer, data):
+    if has_sendmsg:
+        sock.sendmsg([header_buffer, data], [], 0, address)
+    else:
+        # sendmsg is not available on all platforms (i.e. Windows), fall back to joining the header and the data
+        sock.sendto(bytes(header_buffer) + data, address)
 
 
 # Description:
-#   Function for closing the server connection, it sends a FIN ACK to the client and closes the connection
+#   Structures from <sys/socket.h> used for sending and receiving many packets with one system call (sendmmsg and
+#   recvmmsg). An iovec points to one buffer, a msghdr holds the buffers (header and data) of one packet, and a
+#   mmsghdr holds one msghdr and the number of bytes sent or received for it
+class IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class MsgHdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(IOVec)), ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", MsgHdr), ("msg_len", ctypes.c_uint)]
+
+
+# Description:
+#   Structure for Py_buffer from the Python C API, used for finding the address of a buffer that can not be
+#   written to (i.e. a packet from the read only memory map of the file)
+class PyBuffer(ctypes.Structure):
+    _fields_ = [("buf", ctypes.c_void_p), ("obj", ctypes.c_void_p), ("len", ctypes.c_ssize_t),
+                ("itemsize", ctypes.c_ssize_t), ("readonly", ctypes.c_int), ("ndim", ctypes.c_int),
+                ("format", ctypes.c_char_p), ("shape", ctypes.c_void_p), ("strides", ctypes.c_void_p),
+                ("suboffsets", ctypes.c_void_p), ("internal", ctypes.c_void_p)]
+
+
+ctypes.pythonapi.PyObject_GetBuffer.argtypes = [ctypes.py_object, ctypes.POINTER(PyBuffer), ctypes.c_int]
+ctypes.pythonapi.PyBuffer_Release.argtypes = [ctypes.POINTER(PyBuffer)]
+
+
+# Description:
+#   Function for finding the memory address of the data in a buffer (bytes, bytearray or memoryview), without
+#   copying it. The address is valid as long as the buffer is kept alive
+# Parameters:
+#   data: holds the buffer
+# Returns:
+#   Returns the address as an integer
+def buffer_address(data):
+    view = PyBuffer()
+    ctypes.pythonapi.PyObject_GetBuffer(data, ctypes.byref(view), 0)  # 0 = PyBUF_SIMPLE
+    address = view.buf
+    ctypes.pythonapi.PyBuffer_Release(ctypes.byref(view))
+    return address
+
+
+# Description:
+#   Class for sending and receiving packets in batches. On Linux it uses sendmmsg and recvmmsg through ctypes, so a
+#   whole window of packets (up to batch_limit) is sent with one system call, and the acks waiting in the socket are
+#   received up to receive_batch_size at a time. If they are not available it falls back to one sendmsg/recvfrom per
+#   packet.
+#   If the kernel supports UDP segmentation offload (UDP_SEGMENT), the packets are instead given to the kernel as one
+#   large buffer with sendmsg, and the kernel splits it into datagrams of segment_size bytes. Every datagram keeps
+#   its own DRTP header, since the buffer is the headers and the data of the packets one after another.
+#   It counts how many system calls were saved compared to sending and receiving one packet at a time.
+# Parameters:
+#   sock: holds the socket
+#   address: holds the address to send to
+#   max_batch: holds the largest number of packets in a batch (the window size), capped at batch_limit
+#   segment_size: holds the size of a full packet (header and data), used for segmentation offload
+# Returns:
+#   itself, it is used by GBN and SR for sending the packets and receiving the acks
+class BatchIO:
+    def __init__(self, sock, address, max_batch, segment_size=None):
+        self.sock = sock
+        self.address = address
+        self.max_batch = min(max_batch, batch_limit)
+        self.syscalls_saved = 0
+        self.queued = 0  # Packets added since the last flush
+        # Waiting for the acks is done with a selector (epoll on Linux), the socket is registered once
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(sock, selectors.EVENT_READ)
+        self.data = []  # The data of the queued packets, kept alive until they are sent
+        self.headers = [bytearray(header_length) for i in range(self.max_batch)]  # One header buffer per packet
+
+        # Use segmentation offload if the kernel has the UDP_SEGMENT option
+        self.segment_size = None
+        if segment_size is not None:
+            try:
+                sock.getsockopt(socket.SOL_UDP, UDP_SEGMENT)
+                self.segment_size = segment_size
+                self.segment_option = [(socket.SOL_UDP, UDP_SEGMENT, struct.pack("=H", segment_size))]
+                self.max_segments = min(max_segments, max_udp_payload // segment_size)
+                print(f"Using UDP segmentation offload, {self.max_segments} packets per system call")
+            except OSError:
+                print("UDP segmentation offload is not available")
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            self.sendmmsg = libc.sendmmsg
+            self.recvmmsg = libc.recvmmsg
+            self.available = True
+        except (OSError, AttributeError):
+            self.available = False
+            print("sendmmsg/recvmmsg is not available, sending one packet at a time")
+            return
+
+        self.sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+        self.recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+
+        # The address to send to as a sockaddr_in: family, port, IPv4 address and 8 bytes of padding
+        self.sockaddr = ctypes.create_string_buffer(
+            struct.pack("=H", socket.AF_INET) + struct.pack("!H", address[1]) + socket.inet_aton(address[0]) +
+            bytes(8), 16)
+
+        # Every packet we send has two buffers: the header and the data
+        self.send_iov = (IOVec * (2 * self.max_batch))()
+        self.send_msgs = (MMsgHdr * self.max_batch)()
+        for i in range(self.max_batch):
+            self.send_iov[2 * i].iov_base = buffer_address(self.headers[i])
+            self.send_iov[2 * i].iov_len = header_length
+            msg = self.send_msgs[i].msg_hdr
+            msg.msg_name = ctypes.addressof(self.sockaddr)
+            msg.msg_namelen = len(self.sockaddr)
+            msg.msg_iov = ctypes.pointer(self.send_iov[2 * i])
+            msg.msg_iovlen = 2
+
+        # Every packet we receive has one buffer, the ring does not depend on the window since the acks are small and
+        # a full ring is received again
+        self.receive_buffers = [bytearray(receive_buffer_size) for i in range(receive_batch_size)]
+        self.receive_iov = (IOVec * receive_batch_size)()
+        self.receive_msgs = (MMsgHdr * receive_batch_size)()
+        for i in range(receive_batch_size):
+            self.receive_iov[i].iov_base = buffer_address(self.receive_buffers[i])
+            self.receive_iov[i].iov_len = receive_buffer_size
+            self.receive_msgs[i].msg_hdr.msg_iov = ctypes.pointer(self.receive_iov[i])
+            self.receive_msgs[i].msg_hdr.msg_iovlen = 1
+
+    # Description:
+    #   Adds a packet to the batch, it is sent on the next flush (or now, if the batch is full)
+    # Parameters:
+    #   sequence_number: holds the sequence number
+    #   acknowledgment_number: holds the acknowledgment number
+    #   flags: holds the flags
+    #   window: holds the window
+    #   data: holds the data
+    # Returns:
+    #   None
+    def add(self, sequence_number, acknowledgment_number, flags, window, data):
+        if self.queued == self.max_batch:
+            self.flush()
+        encode_header_into(self.headers[self.queued], sequence_number, acknowledgment_number, flags, window)
+        if self.available:
+            data_iov = self.send_iov[2 * self.queued + 1]
+            data_iov.iov_base = buffer_address(data) if len(data) > 0 else None
+            data_iov.iov_len = len(data)
+        self.data.append(data)
+        self.queued += 1
+
+    # Description:
+    #   Sends all the packets in the batch
+    # Parameters:
+    #   None
+    # Returns:
+    #   None
+    def flush(self):
+        if self.segment_size is not None:
+            self.flush_segmented()
+        elif not self.available:
+            for i in range(self.queued):
+                send_packet(self.sock, self.address, self.headers[i], self.data[i])
+        else:
+            sent = 0
+            calls = 0
+            while sent < self.queued:
+                count = self.sendmmsg(self.sock.fileno(),
+                                      ctypes.addressof(self.send_msgs) + sent * ctypes.sizeof(MMsgHdr),
+                                      self.queued - sent, 0)
+                if count < 0:
+                    error = ctypes.get_errno()
+                    if error in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        # The send buffer is full, wait until there is room
+                        select.select([], [self.sock], [])
+                        continue
+                    if error == errno.EINTR:
+                        continue
+                    raise OSError(error, os.strerror(error))
+                sent += count
+                calls += 1
+            self.syscalls_saved += self.queued - calls
+        self.queued = 0
+        self.data.clear()
+
+    # Description:
+    #   Sends the packets in the batch with segmentation offload, as few large buffers as possible. All the packets
+    #   in a buffer except the last must be exactly segment_size long, a shorter packet ends the buffer
+    # Parameters:
+    #   None
+    # Returns:
+    #   None
+    def flush_segmented(self):
+        start = 0
+        while start < self.queued:
+            end = start
+            buffers = []
+            while end < self.queued and end - start < self.max_segments:
+                buffers += [self.headers[end], self.data[end]]
+                end += 1
+                if header_length + len(self.data[end - 1]) != self.segment_size:
+                    break
+            try:
+                self.sock.sendmsg(buffers, self.segment_option, 0, self.address)
+            except OSError as e:
+                # The route or the device can not do segmentation offload, send the rest without it
+                print(f"UDP segmentation offload failed ({e}), sending without it")
+                self.segment_size = None
+                for i in range(start, self.queued):
+                    send_packet(self.sock, self.address, self.headers[i], self.data[i])
+                return
+            self.syscalls_saved += end - start - 1
+            start = end
+
+    # Description:
+    #   Receives all the packets that are waiting in the socket, without waiting for more
+    # Parameters:
+    #   None
+    # Returns:
+    #   Returns a list with the header fields and the data of each packet, like strip_packet
+    def receive(self):
+        packets = []
+        if not self.available:
+            while self.selector.select(0):
+                raw_data, address = self.sock.recvfrom(receive_buffer_size)
+                packets.append(strip_packet(raw_data))
+            return packets
+
+        # Receive until the socket is empty, a full ring means there can be more waiting
+        count = receive_batch_size
+        while count == receive_batch_size:
+            count = self.recvmmsg(self.sock.fileno(), ctypes.addressof(self.receive_msgs), receive_batch_size,
+                                  socket.MSG_DONTWAIT, None)
+            if count < 0:
+                error = ctypes.get_errno()
+                if error in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return packets
+                raise OSError(error, os.strerror(error))
+            for i in range(count):
+                packets.append(strip_packet(bytes(self.receive_buffers[i][:self.receive_msgs[i].msg_len])))
+            if count > 1:
+                self.syscalls_saved += count - 1
+        return packets
+
+    # Description:
+    #   Waits until there are packets to receive in the socket, or the timeout runs out
+    # Parameters:
+    #   timeout: holds the longest time to wait in seconds
+    # Returns:
+    #   Returns True if there are packets to receive, False if the timeout ran out
+    def wait(self, timeout):
+        return bool(self.selector.select(timeout))
+
+
+# Description:
+#   Class for estimating the round trip time and calculating the retransmission timeout (RTO), based on RFC 6298.
+#   It keeps a smoothed RTT and the RTT variance, the timeout is SRTT + 4 * RTTVAR within min_rto and max_rto.
+#   The longest time the server holds back an ack is added to it, like the max_ack_delay of RFC 9002, so an ack that
+#   is held back does not make the packet time out.
+#   The timeout is doubled for every timeout in a row (backoff), and reset when a new RTT sample is taken.
+#   Following Karn's rule, the protocols only take samples from packets that were not retransmitted.
+# Parameters:
+#   initial_rtt: holds the RTT measured in the handshake, used as the first sample, or None if it was not measured
+#   ack_delay: holds the longest time in seconds the server holds back an ack, from the handshake
+# Returns:
+#   itself, it is used by stop_and_wait, GBN and SR for deciding when to retransmit
+class RttEstimator:
+    def __init__(self, initial_rtt, ack_delay=default_ack_delay):
+        self.backoff_factor = 1
+        self.ack_delay = ack_delay
+        self.rto = 0
+        if initial_rtt is None:
+            # Without a sample the timeout is the initial RTO of RFC 6298, and the first sample sets the estimate
+            self.sampled = False
+            self.srtt = syn_timeout
+            self.rttvar = 0
+        else:
+            # The first sample sets the smoothed RTT, and the variance to half of it
+            self.sampled = True
+            self.srtt = initial_rtt
+            self.rttvar = initial_rtt / 2
+        self.calculate_rto()
+
+    # Description:
+    #   Calculates the retransmission timeout from the smoothed RTT, the variance and the backoff
+    # Parameters:
+    #   None
+    # Returns:
+    #   None
+    def calculate_rto(self):
+        rto = max(min_rto, self.srtt + max(clock_granularity, 4 * self.rttvar) + self.ack_delay)
+        self.rto = min(max_rto, rto * self.backoff_factor)
+
+    # Description:
+    #   Updates the estimate with a new RTT sample, alpha = 1/8 and beta = 1/4 from RFC 6298
+    # Parameters:
+    #   sample: holds the measured RTT in seconds
+    # Returns:
+    #   None
+    def update(self, sample):
+        if not self.sampled:
+            self.sampled = True
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+            self.srtt = 0.875 * self.srtt + 0.125 * sample
+        self.backoff_factor = 1
+        self.calculate_rto()
+
+    # Description:
+    #   Doubles the retransmission timeout after a timeout, up to max_rto
+    # Parameters:
+    #   None
+    # Returns:
+    #   None
+    def backoff(self):
+        if self.rto < max_rto:
+            self.backoff_factor *= 2
+        self.calculate_rto()
+
+    # Description:
+    #   Calculates the probe timeout of the tail loss probe, 2 * SRTT and the time the server can hold back an ack,
+    #   based on RFC 8985. It is never later than the retransmission timeout
+    # Parameters:
+    #   None
+    # Returns:
+    #   Returns the probe timeout in seconds
+    def probe_timeout(self):
+        return min(self.rto, 2 * self.srtt + self.ack_delay)
+
+
+# Description:
+#   Class for congestion control, it decides how many packets GBN and SR can have in flight. This class keeps the
+#   window fixed at the size given with -w, the other algorithms change the window and use -w as the upper bound.
+# Parameters:
+#   max_window: holds the largest window in packets, from -w
+# Returns:
+#   itself, GBN and SR call window() before sending, and tell it about acks, losses and timeouts
+class CongestionControl:
+    def __init__(self, max_window):
+        self.max_window = max_window
+        self.cwnd = max_window  # The congestion window in packets, it can be a fraction
+        self.ssthresh = max_window  # The slow start threshold in packets
+
+    # Description:
+    #   Returns the number of packets that can be in flight
+    # Parameters:
+    #   None
+    # Returns:
+    #   Returns the window in whole packets, from 1 up to max_window
+    def window(self):
+        return max(1, min(self.max_window, int(self.cwnd)))
+
+    # Description:
+    #   Called when new packets are acked
+    # Parameters:
+    #   acked_packets: holds the number of packets acked
+    #   rtt_sample: holds the RTT measured for a packet that was sent once, or None
+    # Returns:
+    #   None
+    def on_ack(self, acked_packets, rtt_sample=None):
+        pass
+
+    # Description:
+    #   Called when a lost packet is found from duplicate acks or SACK blocks, at most once per window
+    # Parameters:
+    #   None
+    # Returns:
+    #   None
+    def on_loss(self):
+        pass
+
+    # Description:
+    #   Called when the retransmission timer expires
+    # Parameters:
+    #   None
+    # Returns:
+    #   None
+    def on_timeout(self):
+        pass
+
+
+# Description:
+#   Class for loss based congestion control like TCP Reno, based on RFC 5681. The window grows by one packet for each
+#   ack in slow start, and by one packet for each window in congestion avoidance. It is halved when a packet is lost,
+#   and it starts again from one packet after a timeout.
+# Parameters:
+#   max_window: holds the largest window in packets, from -w
+# Returns:
+#   itself
+class RenoCongestionControl(CongestionControl):
+    def __init__(self, max_window):
+        super().__init__(max_window)
+        self.cwnd = min(initial_congestion_window, max_window)
+
+    # Description:
+    #   Grows the window, in slow start or in congestion avoidance
+    # Parameters:
+    #   acked_packets: holds the number of packets acked
+    #   rtt_sample: holds the RTT measured for a packet that was sent once, or None
+    # Returns:
+    #   None
+    def on_ack(self, acked_packets, rtt_sample=None):
+        for i in range(acked_packets):
+            if self.cwnd < self.ssthresh:
+                self.cwnd += 1
+            else:
+                self.cwnd += 1 / self.cwnd
+        # The window does not grow past the upper bound, so it can go down right away after a loss
+        self.cwnd = min(self.cwnd, self.max_window)
+
+    # Description:
+    #   Halves the window after a loss
+    # Parameters:
+    #   None
+    # Returns:
+    #   None
+    def on_loss(self):
+        self.ssthresh = max(self.window() / 2, 2)
+        self.cwnd = self.ssthresh
+
+    # Description:
+    #   Starts from one packet after a timeout, with slow start up to half of the old window
+    # Parameters:
+    #   None
+    # Returns:
+    #   None
+    def on_timeout(self):
+        self.ssthresh = max(self.window() / 2, 2)
+        self.cwnd = 1
+
+
+# Description:
+#   Class for delay based congestion control like TCP Vegas. It compares the RTT with the lowest RTT seen, to estimate
+#   how many packets are waiting in the queues of the network. The window grows while fewer than delay_alpha packets are
+#   queued and shrinks when more than delay_beta packets are queued, so the queues in the routers stay short.
+#   Losses and timeouts are handled like Reno.
+# Parameters:
+#   max_window: holds the largest window in packets, from -w
+# Returns:
+#   itself
+class DelayCongestionControl(RenoCongestionControl):
+    def __init__(self, max_window):
+        super().__init__(max_window)
+        self.base_rtt = None  # The lowest RTT seen, the RTT without queues
+        self.rtt = None  # The last RTT measured
+        self.acks_in_round = 0  # The window is changed once for each window of acks
+
+    # Description:
+    #   Changes the window from the estimated number of queued packets
+    # Parameters:
+    #   acked_packets: holds the number of packets acked
+    #   rtt_sample: holds the RTT measured for a packet that was sent once, or None
+    # Returns:
+    #   None
+    def on_ack(self, acked_packets, rtt_sample=None):
+        if rtt_sample is not None:
+            self.rtt = rtt_sample
+            self.base_rtt = rtt_sample if self.base_rtt is None else min(self.base_rtt, rtt_sample)
+        if self.rtt is None:
+            # No RTT measured yet, grow like Reno
+            super().on_ack(acked_packets, rtt_sample)
+            return
+
+        # The number of our packets waiting in queues: window * (1 - lowest RTT / RTT)
+        queued_packets = self.cwnd * (1 - self.base_rtt / self.rtt) if self.rtt > 0 else 0
+        if self.cwnd < self.ssthresh:
+            # Slow start until packets start to queue
+            if queued_packets > delay_alpha:
+                self.ssthresh = self.cwnd
+            else:
+                self.cwnd += acked_packets
+        else:
+            self.acks_in_round += acked_packets
+            if self.acks_in_round >= self.cwnd:
+                self.acks_in_round = 0
+                if queued_packets < delay_alpha:
+                    self.cwnd += 1
+                elif queued_packets > delay_beta:
+                    self.cwnd = max(1, self.cwnd - 1)
+        self.cwnd = min(self.cwnd, self.max_window)
+
+
+# The congestion control algorithms that can be chosen with -cc
+congestion_controls = {"fixed": CongestionControl, "reno": RenoCongestionControl, "delay": DelayCongestionControl}
+
+
+# Description:
+#   Class for pacing the packets of GBN and SR with a token bucket, so a window is spread out in time instead of being
+#   sent back to back. Bursts fill up the small router queues and cause the losses we then wait for timeouts for.
+#   The bucket fills with rate bytes per second, up to pacing_burst packets, and a packet can be sent when there are
+#   tokens for it. The rate is either given, or the window divided by the smoothed RTT times pacing_gain, so the
+#   window is sent over a little less than one RTT.
+#   The selector only waits whole milliseconds, so the sender waits in its event loop for the part of a gap that is
+#   longer than pacing_spin_time, and the last part is waited for here by checking the clock. The time between the
+#   packets that were sent is measured, and reported at the end.
+# Parameters:
+#   packet_size: holds the size of a full packet in bytes, header and data
+#   rate: holds the rate in bytes per second, or None to pace from the window and the RTT
+# Returns:
+#   itself, it is used by GBN and SR for deciding when the next packet can be sent
+class Pacer:
+    def __init__(self, packet_size, rate=None):
+        self.packet_size = packet_size
+        self.fixed_rate = rate
+        self.rate = rate
+        self.capacity = pacing_burst * packet_size
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        # The time between the packets that were sent
+        self.last_sent = None
+        self.gaps = 0
+        self.gap_total = 0.0
+        self.gap_min = None
+        self.gap_max = 0.0
+
+    # Description:
+    #   Sets the rate from the window and the RTT, if no rate was given
+    # Parameters:
+    #   window: holds the number of packets that can be in flight
+    #   srtt: holds the smoothed RTT in seconds
+    # Returns:
+    #   None
+    def update(self, window, srtt):
+        if self.fixed_rate is None:
+            # A microsecond is the shortest RTT used, the handshake on a fast loopback can measure close to 0
+            self.rate = pacing_gain * window * self.packet_size / max(srtt, 0.000001)
+
+    # Description:
+    #   Calculates how long to wait before the next packet can be sent
+    # Parameters:
+    #   size: holds the size of the packet in bytes, header and data
+    # Returns:
+    #   Returns the time to wait in seconds, 0 if the packet can be sent now
+    def delay(self, size):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+        if self.tokens >= size:
+            return 0
+        return (size - self.tokens) / self.rate
+
+    # Description:
+    #   Waits a gap that is too short for the selector by checking the clock
+    # Parameters:
+    #   pause: holds the time to wait in seconds
+    # Returns:
+    #   None
+    def spin(self, pause):
+        until = time.monotonic() + pause
+        while time.monotonic() < until:
+            pass
+
+    # Description:
+    #   Decides if the next packet can be sent now. A gap shorter than pacing_spin_time is waited for here, after the
+    #   packets in the batch are sent, so they are not held back by the wait
+    # Parameters:
+    #   size: holds the size of the packet in bytes, header and data
+    #   batch: holds the BatchIO the packets are sent with
+    # Returns:
+    #   Returns 0 if the packet can be sent now, or how long the sender waits in its event loop before trying again
+    def next_send(self, size, batch):
+        pause = self.delay(size)
+        if pause > 0:
+            batch.flush()
+            if pause > pacing_spin_time:
+                return pause - pacing_spin_time
+            self.spin(pause)
+        self.consume(size)
+        return 0
+
+    # Description:
+    #   Takes the tokens for a packet that is sent, and measures the time since the last packet
+    # Parameters:
+    #   size: holds the size of the packet in bytes, header and data
+    # Returns:
+    #   None
+    def consume(self, size):
+        self.delay(size)
+        self.tokens -= size
+        now = self.last_refill
+        if self.last_sent is not None:
+            gap = now - self.last_sent
+            self.gaps += 1
+            self.gap_total += gap
+            self.gap_min = gap if self.gap_min is None else min(self.gap_min, gap)
+            self.gap_max = max(self.gap_max, gap)
+        self.last_sent = now
+
+    # Description:
+    #   Prints the rate and the time between the packets that were sent
+    # Parameters:
+    #   None
+    # Returns:
+    #   None
+    def report(self):
+        print(f"Pacing rate at the end: {self.rate * 8 / 1000000:.2f} Mbps")
+        if self.gaps:
+            print(f"Packet spacing: average {self.gap_total / self.gaps * 1000000:.1f} us, "
+                  f"min {self.gap_min * 1000000:.1f} us, max {self.gap_max * 1000000:.1f} us")
+
+
+# Description:
+#   Class for the forward error correction (FEC) of the SR client. The new data packets are split into blocks of
+#   block_size packets, and parity packets are sent after each block. Parity packet j is the XOR of the packets j,
+#   j + k, j + 2k ... of the block, so the server can rebuild one lost packet of each of them, i.e. up to k packets
+#   lost in a row, without waiting for a retransmission. The XOR is done on whole packets as Python integers, which
+#   is one operation in C per packet. The number of parity packets is given, or adapted to the loss rate measured
+#   from the packets that are sent again: fec_redundancy times the packets lost in a block, up to max_fec_parity.
+#   On a path without loss the adaptive FEC sends no parity packets.
+# Parameters:
+#   block_size: holds the number of data packets in a block
+#   parity_count: holds the number of parity packets for each block, or None to adapt it to the loss rate
+# Returns:
+#   itself, it is used by SR for sending the parity packets
+class FecEncoder:
+    def __init__(self, block_size, parity_count=None):
+        self.block_size = block_size
+        self.adaptive = parity_count is None
+        self.parity_count = 1 if parity_count is None else parity_count
+        self.block_parity_count = self.parity_count  # The parity packets of the block that is being sent
+        self.block_sequence_number = 0  # The sequence number of the first packet in the block
+        self.count = 0  # The packets in the block so far
+        self.parity = []  # The XOR of the packets for each parity packet
+        self.lengths = []  # The XOR of the lengths of the packets for each parity packet
+        # The loss rate, from the packets sent again since the last block
+        self.lost = 0
+        self.loss_rate = 0.0
+        self.blocks = 0
+        self.data_packets = 0
+        self.parity_packets = 0
+
+    # Description:
+    #   Adds a new data packet to the block
+    # Parameters:
+    #   sequence_number: holds the sequence number of the packet
+    #   data: holds the payload of the packet
+    # Returns:
+    #   None
+    def add(self, sequence_number, data):
+        if self.count == 0:
+            self.block_sequence_number = sequence_number
+            self.block_parity_count = self.parity_count
+            self.parity = [0] * self.block_parity_count
+            self.lengths = [0] * self.block_parity_count
+        if self.block_parity_count:
+            j = self.count % self.block_parity_count
+            # Little endian, so a shorter packet is padded with zeros at the end
+            self.parity[j] ^= int.from_bytes(data, "little")
+            self.lengths[j] ^= len(data)
+        self.count += 1
+        self.data_packets += 1
+
+    # Description:
+    #   Counts packets that had to be sent again, for the loss rate
+    # Parameters:
+    #   packets: holds the number of packets sent again
+    # Returns:
+    #   None
+    def on_loss(self, packets=1):
+        self.lost += packets
+
+    # Description:
+    #   Adds the parity packets of the block to the batch if the block is full, or if last is True
+    # Parameters:
+    #   batch: holds the BatchIO to send the parity packets with
+    #   last: holds whether the last data packet has been added, the block is sent even if it is not full
+    # Returns:
+    #   None
+    def flush(self, batch, last=False):
+        if self.count == 0 or (self.count < self.block_size and not last):
+            return
+        for j in range(self.block_parity_count):
+            data = self.parity[j].to_bytes((self.parity[j].bit_length() + 7) // 8, "little")
+            batch.add(self.block_sequence_number, self.count << 16 | self.block_parity_count << 8 | j, flag_parity,
+                      self.lengths[j], data)
+            self.parity_packets += 1
+        self.blocks += 1
+        # Adapt the number of parity packets to the packets lost since the last block
+        self.loss_rate = 0.75 * self.loss_rate + 0.25 * min(1.0, self.lost / self.count)
+        self.lost = 0
+        if self.adaptive:
+            self.parity_count = min(max_fec_parity, self.block_size,
+                                    math.ceil(fec_redundancy * self.loss_rate * self.block_size))
+        self.count = 0
+
+    # Description:
+    #   Prints the parity packets sent, the overhead and the measured loss rate
+    # Parameters:
+    #   None
+    # Returns:
+    #   None
+    def report(self):
+        print(f"FEC: {self.parity_packets} parity packets for {self.data_packets} data packets in "
+              f"{self.blocks} blocks, {self.parity_packets / max(self.data_packets, 1):.1%} overhead, "
+              f"loss rate {self.loss_rate:.2%}, "
+              f"{self.parity_count} parity packets per block at the end")
+
+
+# Description:
+#   Class for rebuilding the lost packets of the SR server from the parity packets of the FecEncoder. It keeps the
+#   parity packets of the blocks that are not written yet, and uses the ring of the server for the data packets.
+#   A parity packet rebuilds a packet when it is the only one it covers that is missing: the XOR of the parity and
+#   the other packets is the missing packet, and the XOR of the lengths is its length.
+# Parameters:
+#   first_sequence_number: holds the sequence number of the first packet
+#   packet_size: holds the size of the data of a full packet
+#   slots: holds the data of the packets in the ring of the server
+#   slot_sequence_numbers: holds the sequence numbers of the packets in the ring
+#   received: holds the bitmap of the slots that hold a packet that is not written yet
+# Returns:
+#   itself, it is used by SR when FEC was agreed on in the handshake
+class FecDecoder:
+    def __init__(self, first_sequence_number, packet_size, slots, slot_sequence_numbers, received):
+        self.first_sequence_number = first_sequence_number
+        self.packet_size = packet_size
+        self.slots = slots
+        self.slot_sequence_numbers = slot_sequence_numbers
+        self.received = received
+        # The parity packets by the packet number of the first packet of their block, as [count, k, j, length, XOR]
+        self.blocks = {}
+
+    # Description:
+    #   Saves a parity packet
+    # Parameters:
+    #   block_start: holds the packet number of the first packet of the block
+    #   fields: holds the ack field of the parity packet, the number of packets, parity packets and the index
+    #   length: holds the window field of the parity packet, the XOR of the lengths
+    #   data: holds the XOR of the packets
+    #   next_packet: holds the next packet the server writes
+    # Returns:
+    #   None
+    def add(self, block_start, fields, length, data, next_packet):
+        count, k, j = fields >> 16, (fields >> 8) & 0xff, fields & 0xff
+        # Blocks that are written already do not need the parity
+        if block_start + count <= next_packet or j >= k:
+            return
+        self.blocks.setdefault(block_start, []).append([count, k, j, length, int.from_bytes(data, "little")])
+
+    # Description:
+    #   Tells if the data of a packet is in the ring, it is buffered or written and its slot is not used again
+    # Parameters:
+    #   packet_number: holds the packet number
+    #   next_packet: holds the next packet the server writes
+    # Returns:
+    #   Returns True if the data of the packet is in its slot
+    def has(self, packet_number, next_packet):
+        slot = packet_number % len(self.slots)
+        return (self.slots[slot] is not None and (self.received[slot] or packet_number < next_packet)
+                and self.slot_sequence_numbers[slot] == self.first_sequence_number + packet_number * self.packet_size)
+
+    # Description:
+    #   Rebuilds the missing packets of the block a packet is in, and forgets the blocks that are written
+    # Parameters:
+    #   packet_number: holds the packet number of the packet that arrived
+    #   next_packet: holds the next packet the server writes
+    # Returns:
+    #   Returns a list with the packet number, the sequence number and the data of each packet that was rebuilt
+    def recover(self, packet_number, next_packet):
+        rebuilt = []
+        for block_start in list(self.blocks):
+            parities = self.blocks[block_start]
+            count = parities[0][0]
+            if block_start + count <= next_packet:
+                del self.blocks[block_start]
+                continue
+            if not block_start <= packet_number < block_start + count:
+                continue
+            for count, k, j, length, value in parities:
+                missing = None
+                for i in range(block_start + j, block_start + count, k):
+                    if self.has(i, next_packet):
+                        data = self.slots[i % len(self.slots)]
+                        value ^= int.from_bytes(data, "little")
+                        length ^= len(data)
+                    elif missing is None:
+                        missing = i
+                    else:
+                        # Two packets are missing, this parity can not rebuild them yet
+                        missing = None
+                        break
+                if missing is not None and 0 < length <= self.packet_size and value.bit_length() <= length * 8:
+                    rebuilt.append((missing, self.first_sequence_number + missing * self.packet_size,
+                                    value.to_bytes(length, "little")))
+        return rebuilt
+
+
+# Description:
+#   Function for closing the server connection, it sends a FIN ACK to the client
 # Parameters:
 #   sock: holds the socket
 #   address: holds the address
 #   sequence_number: holds the sequence number
 #   receiver_window: holds the receiver window
 # Returns:
-#   Returns nothing, it sends a FIN ACK to the client and closes the connection
+#   Returns the FIN ACK, linger_server_connection sends it again if the client sends the FIN again
 def close_server_connection(sock, address, sequence_number, receiver_window):
     # If we receive the FIN from the client, send an ACK
     print("Received FIN from the client")
@@ -209,18 +1238,665 @@ def close_server_connection(sock, address, sequence_number, receiver_window):
     packet = encode_header(sequence_number, acknowledgment_number, flags, receiver_window)
     sock.sendto(packet, address)
     print("Sent FIN ACK to the client")
-    # Close the connection on the
+    return packet
+
+
+# Description:
+#   Function for waiting after the FIN ACK before the server connection is closed, like TIME-WAIT in TCP. If the FIN
+#   ACK was lost the client sends the FIN again, and it is answered until no FIN has come for fin_linger_time
+# Parameters:
+#   sock: holds the socket
+#   address: holds the address
+#   packet: holds the FIN ACK
+# Returns:
+#   Returns nothing, it closes the connection
+def linger_server_connection(sock, address, packet):
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ)
+    while selector.select(fin_linger_time):
+        raw_data, sender = sock.recvfrom(receive_buffer_size)
+        syn, ack, fin, rst = parse_flags(strip_packet(raw_data)[2])
+        if fin and sender == address:
+            sock.sendto(packet, address)
+            print("Sent FIN ACK to the client again")
+    selector.close()
+    # Close the connection on the server side
     sock.close()
 
 
-# Description:
-#   Create a random initial sequence number for the three-way handshake
-# Parameters:
-#   None
-# Returns:
-#   Returns a random initial sequence number as an integer (32 bits)
-def random_isn():
-    return random.randint(0, 2 ** 32 - 1)
+# Description:
+#   Function for sending a packet of the handshake or the closing handshake and waiting for the answer. If no answer
+#   comes within the timeout, the packet is sent again with the timeout doubled, up to max_control_retries times
+# Parameters:
+#   sock: holds the socket
+#   address: holds the address to send the packet to
+#   packet: holds the packet
+#   timeout: holds the first timeout in seconds
+# Returns:
+#   Returns the received data, the address it came from and the number of times the packet was sent again, or None
+#   if no answer came
+def send_until_answered(sock, address, packet, timeout):
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ)
+    try:
+        for attempt in range(max_control_retries + 1):
+            sock.sendto(packet, address)
+            if attempt:
+                print(f"No answer, sent the packet again (try {attempt + 1})")
+            if selector.select(timeout):
+                return sock.recvfrom(receive_buffer_size) + (attempt,)
+            timeout = min(max_rto, 2 * timeout)
+        return None
+    finally:
+        selector.close()
+
+
+# Description:
+#   Create a random initial sequence number for the three-way handshake
+# Parameters:
+#   None
+# Returns:
+#   Returns a random initial sequence number as an integer (32 bits)
+def random_isn():
+    return random.randint(0, 2 ** 32 - 1)
+
+
+# Description:
+#   Class for reading the file to send lazily, one packet at a time, instead of holding the whole file in memory.
+#   The file is memory mapped, so a packet is a memoryview into the page cache and only the pages of the packets
+#   in the current window are read. It can be indexed like the old list of packets, so packets[i] and len(packets)
+#   work as before. The first packet carries the padded filename in front of the file data, and the last packet is
+#   empty, just like the packets read with f.read() in a loop.
+# Parameters:
+#   filename: holds the name of the file to send
+#   packet_size: holds the payload size of each packet (receiver window - header length)
+# Returns:
+#   itself, it is used as the packets to send by stop_and_wait, GBN and SR
+class PacketReader:
+    def __init__(self, filename, packet_size):
+        self.file = open(filename, 'rb')
+        self.filesize = os.fstat(self.file.fileno()).st_size
+        self.packet_size = packet_size
+
+        # An empty file can not be memory mapped, use an empty buffer instead
+        if self.filesize > 0:
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            # Tell the kernel we read the file from start to end, so it can read ahead and drop old pages
+            if hasattr(self.mmap, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+                self.mmap.madvise(mmap.MADV_SEQUENTIAL)
+            self.view = memoryview(self.mmap)
+        else:
+            self.mmap = None
+            self.view = memoryview(b"")
+
+        # Pad the filename with null bytes to make it 32 bytes long, and add it in front of the first chunk
+        encoded_filename = filename.encode().ljust(max_filename_length, b'\0')
+        self.first_chunk_size = packet_size - max_filename_length
+        self.first_packet = encoded_filename + bytes(self.view[:self.first_chunk_size])
+
+        # The first packet, the full packets after it (rounded up) and the empty packet at the end
+        remaining = max(0, self.filesize - self.first_chunk_size)
+        self.packet_count = 1 + (remaining + packet_size - 1) // packet_size + 1
+
+    def __len__(self):
+        return self.packet_count
+
+    # Description:
+    #   Returns the payload of packet number i, without copying the file data
+    # Parameters:
+    #   i: holds the packet number
+    # Returns:
+    #   Returns the payload as bytes (first packet) or a memoryview into the file
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.packet_count
+        if i < 0 or i >= self.packet_count:
+            raise IndexError("packet index out of range")
+        if i == 0:
+            return self.first_packet
+        start = self.first_chunk_size + (i - 1) * self.packet_size
+        return self.view[start:start + self.packet_size]
+
+    # Description:
+    #   Returns where packet number i starts in the data, all packets are full except the last two
+    # Parameters:
+    #   i: holds the packet number, from 0 up to the number of packets
+    # Returns:
+    #   Returns the offset in bytes from the first sequence number
+    def offset(self, i):
+        return min(i * self.packet_size, max_filename_length + self.filesize)
+
+    # Description:
+    #   Returns the number of the packet that starts at an offset, the opposite of offset()
+    # Parameters:
+    #   offset: holds the offset in bytes from the first sequence number
+    # Returns:
+    #   Returns the packet number, the offset of the end of the data gives the empty packet at the end
+    def packet_number(self, offset):
+        return -(-offset // self.packet_size)
+
+    # Description:
+    #   Releases the memory map and closes the file
+    # Parameters:
+    #   None
+    # Returns:
+    #   None
+    def close(self):
+        self.view.release()
+        if self.mmap is not None:
+            self.mmap.close()
+        self.file.close()
+
+
+# Description:
+#   Class for receiving packets with UDP receive offload (GRO). The kernel joins datagrams from the same sender into
+#   one large buffer, so many packets are received with one system call. The size of each datagram is given in the
+#   control message, and the buffer is split back into DRTP packets (each with its own header).
+# Parameters:
+#   sock: holds the socket, GRO must be enabled on it with enable_gro()
+# Returns:
+#   itself, it is used by the writers for receiving the packets
+class GROReceiver:
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray(max_udp_payload)
+        self.view = memoryview(self.buffer)
+        self.packets = collections.deque()  # Packets split from the last buffer, not yet returned
+        self.address = None
+        self.control_size = socket.CMSG_SPACE(struct.calcsize("=i"))
+
+    # Description:
+    #   Returns the next packet, and receives a new buffer from the socket when all packets have been returned
+    # Parameters:
+    #   None
+    # Returns:
+    #   Returns the packet (a memoryview, valid until the next buffer is received) and the address of the sender
+    def receive(self):
+        while not self.packets:
+            length, ancdata, msg_flags, self.address = self.sock.recvmsg_into([self.buffer], self.control_size)
+            # If the kernel did not join any datagrams there is no control message, and the buffer is one packet
+            segment_size = length
+            for level, kind, data in ancdata:
+                if level == socket.SOL_UDP and kind == UDP_GRO:
+                    segment_size = struct.unpack_from("=i", data)[0]
+            for start in range(0, length, max(segment_size, 1)):
+                self.packets.append(self.view[start:min(start + segment_size, length)])
+        return self.packets.popleft(), self.address
+
+    # Description:
+    #   Tells if there are packets from the last buffer that have not been returned yet
+    # Parameters:
+    #   None
+    # Returns:
+    #   Returns True if receive() returns a packet without receiving from the socket
+    def pending(self):
+        return bool(self.packets)
+
+
+# Description:
+#   Function for enabling UDP receive offload (GRO) on a socket
+# Parameters:
+#   sock: holds the socket
+# Returns:
+#   Returns a GROReceiver if the kernel supports it, else None
+def enable_gro(sock):
+    try:
+        sock.setsockopt(socket.SOL_UDP, UDP_GRO, 1)
+    except OSError:
+        print("UDP receive offload is not available")
+        return None
+    print("Using UDP receive offload")
+    return GROReceiver(sock)
+
+
+# Description:
+#   Class for writing the received file to disk while the transfer is running. The protocol puts the data it has
+#   received in order into a bounded queue, and a background thread writes it to the file. The receiver never waits
+#   for the disk: if the queue is full the packet is not accepted, and the free space in the queue is advertised in
+#   the window field of the acks, so a slow disk throttles the sender instead of blocking the acks.
+#   The first 32 bytes of the data is the padded filename, the file is created when they have arrived.
+# Parameters:
+#   path: holds the folder to save the file in
+#   packet_size: holds the largest payload of a packet, used for calculating the free space in bytes
+#   queue_size: holds the number of packets the queue can hold
+#   gro_receiver: holds the GROReceiver to receive the packets with, or None
+#   window_limit: holds the largest window in bytes, the datagrams the socket receive buffer can hold
+#   window_scale: holds the window scale shift agreed on in the handshake
+#   fixed_window: holds the window to advertise instead of the free space, for older clients that take the window of
+#   an ack as the size of the next packet they receive, or None
+# Returns:
+#   itself, it is passed to stop_and_wait, GBN and SR as the writer for the received data
+class FileWriter:
+    def __init__(self, path, packet_size, queue_size, gro_receiver=None, window_limit=max_advertised_window,
+                 window_scale=0, fixed_window=None):
+        self.path = path
+        self.gro_receiver = gro_receiver
+        self.packet_size = packet_size
+        self.window_limit = window_limit
+        self.window_scale = window_scale
+        self.fixed_window = fixed_window
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.bytes_received = 0  # Bytes accepted from the protocol, including the filename
+        self.filename = None
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Description:
+    #   Hands the next in order data to the writer thread, without blocking
+    # Parameters:
+    #   data: holds the payload of the packet
+    # Returns:
+    #   Returns True if the data was accepted, False if the queue is full and the packet must be dropped
+    def write(self, data):
+        try:
+            self.queue.put_nowait(data)
+        except queue.Full:
+            return False
+        self.bytes_received += len(data)
+        return True
+
+    # Description:
+    #   Receives the next packet from the socket
+    # Parameters:
+    #   sock: holds the socket
+    # Returns:
+    #   Returns the header fields, the data and the address of the sender as a tuple
+    def receive(self, sock):
+        if self.gro_receiver is not None:
+            raw_data, address = self.gro_receiver.receive()
+            # Copy the packet out of the GRO buffer, it is reused for the next buffer
+            return strip_packet(bytes(raw_data)) + (address,)
+        raw_data, address = sock.recvfrom(receive_buffer_size)
+        return strip_packet(raw_data) + (address,)
+
+    # Description:
+    #   Returns the data of a packet that was not received from the socket (rebuilt from parity packets), it is
+    #   written when it is in order like all data
+    # Parameters:
+    #   sequence_number: holds the sequence number of the packet
+    #   data: holds the payload of the packet
+    # Returns:
+    #   Returns the data
+    def place(self, sequence_number, data):
+        return bytes(data)
+
+    # Description:
+    #   Calculates the window to advertise in the acks from the free space in the queue
+    # Parameters:
+    #   None
+    # Returns:
+    #   Returns the free space in bytes, shifted by the window scale and limited to what fits in the window field
+    def advertised_window(self):
+        if self.fixed_window is not None:
+            return self.fixed_window
+        free_packets = self.queue.maxsize - self.queue.qsize()
+        window = min(free_packets * self.packet_size, self.window_limit)
+        return min(window >> self.window_scale, max_advertised_window)
+
+    # Description:
+    #   Runs in the writer thread, takes data from the queue and writes it to the file until close() is called
+    # Parameters:
+    #   None
+    # Returns:
+    #   None
+    def run(self):
+        file = None
+        filename_data = b""
+        try:
+            while True:
+                data = self.queue.get()
+                # None is put in the queue by close() when the transfer is done
+                if data is None:
+                    break
+                if file is None:
+                    # Collect the first 32 bytes, and create the file when we have the whole filename
+                    filename_data += data
+                    if len(filename_data) < max_filename_length:
+                        continue
+                    # Decode the filename to bytes and remove the padding
+                    self.filename = filename_data[:max_filename_length].decode().strip("\0'")
+                    file = open(os.path.join(os.getcwd(), self.path, self.filename), 'wb')
+                    data = filename_data[max_filename_length:]
+                file.write(data)
+        except OSError as e:
+            self.error = e
+            # Keep emptying the queue, so the receiver does not see a full queue forever
+            while self.queue.get() is not None:
+                pass
+        finally:
+            if file is not None:
+                file.close()
+
+    # Description:
+    #   Waits for the writer thread to write the rest of the queue to the file
+    # Parameters:
+    #   None
+    # Returns:
+    #   Returns the name of the file that was written, or None if no file was created
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            print_error(f"Could not write the file: {self.error}")
+        return self.filename
+
+
+# Description:
+#   Class for receiving the file straight into its place in the output file. The file is created with the size from
+#   the handshake and memory mapped. For each packet the header is peeked at first, and the packet is then received
+#   with recvmsg_into into two buffers: the header buffer, and the part of the memory map where the data belongs.
+#   The data is never copied in Python, also when packets arrive out of order. The filename in the first 32 bytes
+#   is received into its own buffer, and the file is renamed to it when the transfer is done.
+#   The pages of the memory map are written back to disk by a thread of its own with fdatasync, so the receiver does
+#   not wait for the disk. The window is the room left for data that is not written back yet, like the free space in
+#   the queue of the FileWriter, so a disk that can not keep up makes the sender slow down.
+#   With receive offload (GRO) many packets arrive in one buffer with their headers between them, so the data can
+#   not be received in place. It is copied into the memory map instead, which is one copy in C per packet in
+#   exchange for one system call per buffer instead of two per packet.
+#   It can be used by stop_and_wait, GBN and SR in the same way as the FileWriter.
+# Parameters:
+#   path: holds the folder to save the file in
+#   file_size: holds the size of the file from the handshake
+#   first_sequence_number: holds the sequence number of the first data packet
+#   gro_receiver: holds the GROReceiver to receive the packets with, or None
+#   window_limit: holds the largest window in bytes, the datagrams the socket receive buffer can hold
+#   window_scale: holds the window scale shift agreed on in the handshake
+# Returns:
+#   itself, it is passed to stop_and_wait, GBN and SR as the writer for the received data
+class MappedFileWriter:
+    def __init__(self, path, file_size, first_sequence_number, gro_receiver=None, window_limit=max_advertised_window,
+                 window_scale=0):
+        self.path = path
+        self.gro_receiver = gro_receiver
+        self.window_limit = window_limit
+        self.window_scale = window_scale
+        self.file_size = file_size
+        self.first_sequence_number = first_sequence_number
+        self.bytes_received = 0  # Bytes accepted from the protocol, including the filename
+        self.filename = None
+        self.header = bytearray(header_length)  # Reused for the header of every packet
+        self.filename_buffer = bytearray(max_filename_length)
+        self.max_data_length = receive_buffer_size - header_length
+
+        # Receive into a hidden file until we know the filename
+        self.temp_path = os.path.join(os.getcwd(), path, f".drtp-{os.getpid()}.part")
+        self.file = open(self.temp_path, 'wb+')
+        try:
+            # Reserve the disk space, so we do not run out of space while the file is memory mapped
+            os.posix_fallocate(self.file.fileno(), 0, file_size)
+        except (AttributeError, OSError):
+            # Not supported on this platform or file system, set the size only
+            os.ftruncate(self.file.fileno(), file_size)
+        self.mmap = mmap.mmap(self.file.fileno(), file_size)
+        self.view = memoryview(self.mmap)
+
+        # The bytes in order that are written back to disk, the thread is woken up when a chunk more has arrived
+        self.flushed = 0
+        self.error = None
+        self.closing = False
+        self.wake = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Description:
+    #   Finds the offset of a packet in the data, from the sequence number in its header. The sequence number is
+    #   extended from the next sequence number we expect, so files larger than 4 GB work
+    # Parameters:
+    #   sequence_number: holds the 32 bit sequence number from the header
+    # Returns:
+    #   Returns the offset in bytes, the filename is the first 32 bytes
+    def file_offset(self, sequence_number):
+        next_sequence_number = self.first_sequence_number + self.bytes_received
+        return unwrap_sequence(sequence_number, next_sequence_number) - self.first_sequence_number
+
+    # Description:
+    #   Receives the next packet from the socket, the data is received straight into the output file
+    # Parameters:
+    #   sock: holds the socket
+    # Returns:
+    #   Returns the header fields, the data (a memoryview into the file) and the address of the sender as a tuple
+    def receive(self, sock):
+        if self.gro_receiver is not None:
+            return self.receive_coalesced()
+
+        # Peek at the header to find out where the data belongs, the packet stays in the socket
+        sock.recv_into(self.header, header_length, socket.MSG_PEEK)
+        sequence_number, acknowledgment_number, flags, receiver_window = decode_header(self.header)
+        offset = self.file_offset(sequence_number)
+
+        if flags & flag_parity:
+            # Parity packets (FEC) are not part of the file, receive them the normal way
+            raw_data, address = sock.recvfrom(receive_buffer_size)
+            return strip_packet(raw_data) + (address,)
+        if offset == 0:
+            # The first packet starts with the filename, followed by the start of the file
+            start = 0
+            buffers = [self.header, self.filename_buffer, self.view[:self.max_data_length - max_filename_length]]
+        elif max_filename_length <= offset <= self.file_size + max_filename_length:
+            start = offset - max_filename_length
+            buffers = [self.header, self.view[start:start + self.max_data_length]]
+        else:
+            # The packet does not belong in the file (i.e. FIN), receive it the normal way
+            raw_data, address = sock.recvfrom(receive_buffer_size)
+            return strip_packet(raw_data) + (address,)
+
+        length, ancdata, msg_flags, address = sock.recvmsg_into(buffers)
+        length -= header_length
+
+        if offset == 0:
+            # Save the filename, and return the filename and the data like it was sent
+            if length >= max_filename_length:
+                self.filename = self.filename_buffer.decode().strip("\0'")
+            data = bytes(self.filename_buffer[:length]) + self.view[:max(0, length - max_filename_length)]
+        else:
+            data = self.view[start:start + length]
+        return sequence_number, acknowledgment_number, flags, receiver_window, data, address
+
+    # Description:
+    #   Receives the next packet with receive offload, and copies the data into its place in the file
+    # Parameters:
+    #   None
+    # Returns:
+    #   Returns the header fields, the data (a memoryview into the file) and the address of the sender as a tuple
+    def receive_coalesced(self):
+        raw_data, address = self.gro_receiver.receive()
+        sequence_number, acknowledgment_number, flags, receiver_window = decode_header(raw_data[:header_length])
+        data = raw_data[header_length:]
+        if flags & flag_parity:
+            # Parity packets (FEC) are not part of the file
+            return sequence_number, acknowledgment_number, flags, receiver_window, bytes(data), address
+        return sequence_number, acknowledgment_number, flags, receiver_window, self.place(sequence_number, data), \
+            address
+
+    # Description:
+    #   Copies the data of a packet into its place in the file, for packets that were not received in place (receive
+    #   offload, or rebuilt from parity packets)
+    # Parameters:
+    #   sequence_number: holds the sequence number of the packet
+    #   data: holds the payload of the packet
+    # Returns:
+    #   Returns the data like receive() does, a memoryview into the file or bytes for the first packet
+    def place(self, sequence_number, data):
+        offset = self.file_offset(sequence_number)
+
+        if offset == 0:
+            # The first packet starts with the filename, followed by the start of the file
+            if len(data) >= max_filename_length:
+                self.filename = bytes(data[:max_filename_length]).decode().strip("\0'")
+            length = min(max(0, len(data) - max_filename_length), self.file_size)
+            self.view[:length] = data[max_filename_length:max_filename_length + length]
+            data = bytes(data)
+        elif max_filename_length <= offset <= self.file_size + max_filename_length:
+            start = offset - max_filename_length
+            length = min(len(data), self.file_size - start)
+            self.view[start:start + length] = data[:length]
+            data = self.view[start:start + length]
+        else:
+            # The packet does not belong in the file (i.e. FIN)
+            data = bytes(data)
+        return data
+
+    # Description:
+    #   Accepts the next in order data, it is already in its place in the file
+    # Parameters:
+    #   data: holds the payload of the packet
+    # Returns:
+    #   Returns True, the data is always accepted
+    def write(self, data):
+        self.bytes_received += len(data)
+        if self.bytes_received - self.flushed >= flush_chunk_size:
+            self.wake.set()
+        return True
+
+    # Description:
+    #   Calculates the window to advertise in the acks, from the room left for data that is not written back to disk
+    #   yet. The limit is the socket receive buffer the datagrams wait in before they are received
+    # Parameters:
+    #   None
+    # Returns:
+    #   Returns the window in bytes, shifted by the window scale and limited to what fits in the window field
+    def advertised_window(self):
+        window = min(max(0, max_unflushed - (self.bytes_received - self.flushed)), self.window_limit)
+        return min(window >> self.window_scale, max_advertised_window)
+
+    # Description:
+    #   Runs in the flush thread, writes the pages of the memory map back to disk each time it is woken up, until
+    #   close() is called. fdatasync releases the GIL, so the receiver keeps receiving while the disk works
+    # Parameters:
+    #   None
+    # Returns:
+    #   None
+    def run(self):
+        try:
+            while True:
+                self.wake.wait()
+                self.wake.clear()
+                if self.closing:
+                    break
+                written = self.bytes_received
+                os.fdatasync(self.file.fileno())
+                self.flushed = written
+        except OSError as e:
+            self.error = e
+            # Stop limiting the window, the data is still in the memory map and written back when it is closed
+            self.flushed = self.file_size + max_filename_length
+
+    # Description:
+    #   Closes the memory map and renames the file to the received filename
+    # Parameters:
+    #   None
+    # Returns:
+    #   Returns the name of the file that was written, or None if no file was created
+    def close(self):
+        self.closing = True
+        self.wake.set()
+        self.thread.join()
+        if self.error is not None:
+            print_error(f"Could not write the file back to disk while receiving: {self.error}")
+        self.view.release()
+        self.mmap.close()
+        self.file.close()
+        if self.filename is None:
+            os.remove(self.temp_path)
+        else:
+            os.replace(self.temp_path, os.path.join(os.getcwd(), self.path, self.filename))
+        return self.filename
+
+
+# Description:
+#   Class for sending the acks of the GBN and SR servers. An ack for a packet that arrived in order is held back
+#   until the given number of packets have arrived in order, or delay seconds have passed, and one ack is sent for
+#   all of them. The acks are cumulative, so the newest ack replaces the one that is held back. Acks for packets out
+#   of order, duplicates and packets that could not be written are sent at once, so the client finds losses just as
+#   fast as before. It counts the acks sent for the data packets received, and reports it at the end.
+# Parameters:
+#   sock: holds the socket
+#   every: holds the number of packets in order to send one ack for, 1 sends an ack for every packet
+#   delay: holds the longest time in seconds an ack is held back
+# Returns:
+#   itself, it is used by GBN and SR for sending the acks when they are the server
+class DelayedAcks:
+    def __init__(self, sock, every=default_ack_every, delay=default_ack_delay):
+        self.sock = sock
+        self.every = every
+        self.delay = delay
+        self.packet = None  # The ack that is held back
+        self.address = None
+        self.held = 0  # The packets in order the held back ack is for
+        self.deadline = None  # When the held back ack must be sent
+        self.data_packets = 0
+        self.acks_sent = 0
+        # The server waits for the socket with a selector while an ack is held back, and sends it when the time is up
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(sock, selectors.EVENT_READ)
+
+    # Description:
+    #   Counts a data packet that was received
+    # Parameters:
+    #   None
+    # Returns:
+    #   None
+    def received(self):
+        self.data_packets += 1
+
+    # Description:
+    #   Sends an ack, or holds it back if it is for a packet that arrived in order
+    # Parameters:
+    #   packet: holds the ack, header and SACK blocks
+    #   address: holds the address to send to
+    #   in_order: holds whether the ack is for a packet that arrived in order and was written
+    # Returns:
+    #   None
+    def send(self, packet, address, in_order):
+        self.packet = packet
+        self.address = address
+        if not in_order:
+            self.flush()
+            return
+        self.held += 1
+        if self.held == 1:
+            self.deadline = time.monotonic() + self.delay
+        if self.held >= self.every:
+            self.flush()
+
+    # Description:
+    #   Sends the held back ack, if there is one
+    # Parameters:
+    #   None
+    # Returns:
+    #   None
+    def flush(self):
+        if self.packet is None:
+            return
+        self.sock.sendto(self.packet, self.address)
+        self.acks_sent += 1
+        self.packet = None
+        self.held = 0
+        self.deadline = None
+
+    # Description:
+    #   Waits for the next packet while an ack is held back, and sends the ack if the time is up first. Packets that
+    #   were received together with receive offload and not returned yet are handled first
+    # Parameters:
+    #   writer: holds the writer the packets are received with
+    # Returns:
+    #   None
+    def wait(self, writer):
+        if self.packet is None or (writer.gro_receiver is not None and writer.gro_receiver.pending()):
+            return
+        if not self.selector.select(max(0, self.deadline - time.monotonic())) or time.monotonic() >= self.deadline:
+            self.flush()
+
+    # Description:
+    #   Prints the acks sent for each data packet received
+    # Parameters:
+    #   None
+    # Returns:
+    #   None
+    def report(self):
+        print(f"Acks sent: {self.acks_sent} for {self.data_packets} data packets, "
+              f"{self.acks_sent / max(self.data_packets, 1):.2f} acks per data packet")
 
 
 # Description
@@ -234,12 +1910,13 @@ def random_isn():
 #   flags: The flags to use from the handshake
 #   receiver_window: The receiver window to use from the handshake
 #   packets: The packets to send (if we are the client) or None (if we are the server)
-#   sliding_window: The sliding window size to use
 #   skip_a_packet: Whether to skip a packet or not
+#   writer: The FileWriter to write the received data to (if we are the server)
+#   rtt: The RttEstimator to use for the retransmission timeout (if we are the client)
 # Returns
-#   sock: The socket to use or the packets received (if we are the server)
+#   sock: The socket to use or the writer with the received data (if we are the server)
 def stop_and_wait(sock, address, sequence_number, acknowledgment_number, flags, receiver_window, packets=None,
-                  skip_a_packet=False):
+                  skip_a_packet=False, writer=None, rtt=None):
     print("Stop and wait")
 
     # Test case to skip a packet
@@ -251,14 +1928,21 @@ def stop_and_wait(sock, address, sequence_number, acknowledgment_number, flags,
     # If we are the client, we have packets to send (not None)
     if packets is not None:
         # We are the client
-        # Get the old timeout from the handshake
-        sock_timeout = sock.gettimeout()
-        # Create the packet to send, and to save the last sent packet as a variable, for resending
-        packet = create_packet(sequence_number, acknowledgment_number, 0, receiver_window, packets[0])
-        # Take the current time
-        sent_time = time.time()
+        # The socket stays blocking, but we only read from it after a selector (epoll on Linux) says it is ready, and
+        # wait for it until the retransmission deadline. A timeout is when the selector returns without it being ready
+        selector = selectors.DefaultSelector()
+        selector.register(sock, selectors.EVENT_READ)
+        # Create the header of the packet to send, the header and the data are saved for resending
+        header = bytearray(header_length)
+        encode_header_into(header, sequence_number, acknowledgment_number, 0, receiver_window)
+        data_to_send = packets[0]
+        # Take the current time, the packet is sent again if it is not acked before the deadline
+        sent_time = time.monotonic()
+        deadline = sent_time + rtt.rto
+        # Karn's rule: the RTT of a retransmitted packet is not used, we do not know which copy was acked
+        retransmitted = False
         # Send the packet
-        sock.sendto(packet, address)
+        send_packet(sock, address, header, data_to_send)
         last_packet_sent = 1
         print(f"Sent: SEQ {sequence_number}, ACK {acknowledgment_number}, {flags}, {receiver_window}")
 
@@ -266,70 +1950,74 @@ def stop_and_wait(sock, address, sequence_number, acknowledgment_number, flags,
         expected_ack = sequence_number + len(packets[0])
         while last_packet_sent < len(packets):
             print("\n")
-            try:
-                # Receive ack from server
-                raw_data, address = sock.recvfrom(receiver_window)
-                # Decode the header
-                sequence_number, acknowledgment_number, flags, receiver_window, data = strip_packet(raw_data)
-                # Parse the flags
-                syn, ack, fin, rst = parse_flags(flags)
+            # Wait for the ack until the retransmission deadline
+            if not selector.select(max(0, deadline - time.monotonic())):
+                print("Timeout, resending")
+                # Double the retransmission timeout, until we get an ack for a packet that was not retransmitted
+                rtt.backoff()
+                deadline = time.monotonic() + rtt.rto
+                retransmitted = True
+                # Resend the last packet
+                send_packet(sock, address, header, data_to_send)
+                print(f"Sent: SEQ {sequence_number}, ACK {acknowledgment_number}, {flags}, {receiver_window}")
+                continue
 
-                print(f"Received: SEQ {sequence_number}, ACK {acknowledgment_number}, {flags}, {receiver_window}")
-
-                # If we receive a packet with the correct ack, send the next packet
-                if ack and acknowledgment_number == expected_ack:
-                    # Set a new timeout for the socket (RTT) * 4
-                    sock_timeout = (time.time() - sent_time) * 4
-                    sock.settimeout(sock_timeout)
-                    # Increase the acknowledgment number
-                    expected_ack = acknowledgment_number + len(packets[last_packet_sent])
-                    # Save the acknowledgment number
-                    holding_ack = acknowledgment_number
-                    # Increase the acknowledgment number by 1 to acknowledge the ack packet
-                    acknowledgment_number = sequence_number + 1
-                    # Set the new sequence number
-                    sequence_number = holding_ack
-                    # Create the header
-                    packet = create_packet(sequence_number, acknowledgment_number, 0, receiver_window,
-                                           packets[last_packet_sent])
-
-                    # If we are testing, skip the last packet
-                    if test_case_packet_counter == test_case_packet_skip and not test_case_done and skip_a_packet:
-                        test_case_done = True
-                        print(f"Skipped packet {test_case_packet_skip}")
-                        continue
-                    test_case_packet_counter += 1
+            # Receive ack from server, the socket is ready so there is a datagram waiting
+            raw_data, address = sock.recvfrom(receive_buffer_size)
+            # Decode the header
+            sequence_number, acknowledgment_number, flags, receiver_window, data = strip_packet(raw_data)
+            # Parse the flags
+            syn, ack, fin, rst = parse_flags(flags)
+
+            print(f"Received: SEQ {sequence_number}, ACK {acknowledgment_number}, {flags}, {receiver_window}")
+            # Extend the 32 bit ack to the full sequence number, it wraps around for large files
+            acknowledgment_number = unwrap_sequence(acknowledgment_number, expected_ack)
+
+            # If we receive a packet with the correct ack, send the next packet
+            if ack and acknowledgment_number == expected_ack:
+                # Update the RTT estimate, the new retransmission timeout is used for the next packet
+                if not retransmitted:
+                    rtt.update(time.monotonic() - sent_time)
+                # Increase the acknowledgment number
+                expected_ack = acknowledgment_number + len(packets[last_packet_sent])
+                # Save the acknowledgment number
+                holding_ack = acknowledgment_number
+                # Increase the acknowledgment number by 1 to acknowledge the ack packet
+                acknowledgment_number = sequence_number + 1
+                # Set the new sequence number
+                sequence_number = holding_ack
+                # Create the header
+                encode_header_into(header, sequence_number, acknowledgment_number, 0, receiver_window)
+                data_to_send = packets[last_packet_sent]
 
+                # If we are testing, skip the packet. It is handled as sent and lost, so it is sent again after
+                # the timeout
+                if test_case_packet_counter == test_case_packet_skip and not test_case_done and skip_a_packet:
+                    test_case_done = True
+                    print(f"Skipped packet {test_case_packet_skip}")
+                else:
+                    test_case_packet_counter += 1
                     # Send the packet
-                    sock.sendto(packet, address)
+                    send_packet(sock, address, header, data_to_send)
                     print(f"Sent: SEQ {sequence_number}, ACK {acknowledgment_number}, {flags}, {receiver_window}")
-                    # Take the current time
-                    sent_time = time.time()
-                    # Increment the sequence number
-                    last_packet_sent += 1
-                else:
-                    print("Wrong ack number, resending")
-                    # Send the old packet again
-                    sock.sendto(packet, address)
-
-            # Wait 500 ms before resending the packet
-            except TimeoutError:
-                print("Timeout, resending")
-                # Set the socket timeout to RTT
-                sock.settimeout(sock_timeout)
-                # Take the current time again
-                sent_time = time.time()
-                # Resend the last packet
-                sock.sendto(packet, address)
-                print(f"Sent: SEQ {sequence_number}, ACK {acknowledgment_number}, {flags}, {receiver_window}")
+                # Take the current time, and start the deadline of the new packet
+                sent_time = time.monotonic()
+                deadline = sent_time + rtt.rto
+                retransmitted = False
+                # Increment the sequence number
+                last_packet_sent += 1
+            else:
+                print("Wrong ack number, resending")
+                # Send the old packet again
+                retransmitted = True
+                send_packet(sock, address, header, data_to_send)
 
+        selector.close()
         # We are done
         return sock
     # Else we are the server
     else:
         # Receive the first packet
-        # Create a list to hold the packets
-        packets = []
         # Initialize the acknowledgement number
         previous_acknowledgment_number = acknowledgment_number - 1
         # Used to save the last sent ack as a variable, for resending
@@ -337,21 +2025,21 @@ def stop_and_wait(sock, address, sequence_number, acknowledgment_number, flags,
 
         # Start receiving packets
         while True:
-            # Receive ack from a client
-            raw_data, address = sock.recvfrom(receiver_window)
-            # Decode the header
-            sequence_number, acknowledgment_number, flags, receiver_window, data = strip_packet(raw_data)
+            # Receive a packet from the client, the writer decides where the data is received to
+            sequence_number, acknowledgment_number, flags, receiver_window, data, address = writer.receive(sock)
             # Parse the flags
             syn, ack, fin, rst = parse_flags(flags)
             print(f"Received: SEQ {sequence_number}, ACK {acknowledgment_number}, {flags}, {receiver_window}")
-            print(f"Expected ACK: {previous_acknowledgment_number + 1}")
+            print(f"Expected ACK: {(previous_acknowledgment_number + 1) & sequence_mask}")
 
             # If the fin flag is set, we are done
             if fin:
                 break
 
-            # If the acknowledgement is equal to the old acknowledgement number, we have received the correct packet
-            if acknowledgment_number == previous_acknowledgment_number + 1:
+            # If the acknowledgement is equal to the old acknowledgement number, we have received the correct packet.
+            # If the writer queue is full the packet is dropped, and the old ack is sent again
+            # The acknowledgement numbers are compared modulo 2^32, they can wrap around
+            if acknowledgment_number == (previous_acknowledgment_number + 1) & sequence_mask and writer.write(data):
                 # Update the new expected acknowledgement number
                 previous_acknowledgment_number = acknowledgment_number
                 # Save the acknowledgement number for creating new sequence number
@@ -360,10 +2048,10 @@ def stop_and_wait(sock, address, sequence_number, acknowledgment_number, flags,
                 acknowledgment_number = sequence_number + len(data)
                 # Set the new sequence number
                 sequence_number = holding_ack
-                # Add the data to the packet list
-                packets.append(data)
                 # Set flags
                 flags = set_flags(0, 1, 0, 0)
+                # Advertise the room the writer has as the window
+                receiver_window = writer.advertised_window()
                 # Create header
                 packet = encode_header(sequence_number, acknowledgment_number, flags, receiver_window)
 
@@ -380,10 +2068,11 @@ def stop_and_wait(sock, address, sequence_number, acknowledgment_number, flags,
             else:
                 # Did not receive the correct packet, resend the last ack
                 print(f"Received duplicate or wrong package: SEQ {sequence_number}, ACK {acknowledgment_number}")
-                print("Expected ack: " + str(previous_acknowledgment_number + 1))
-                sock.sendto(packet, address)
+                print("Expected ack: " + str((previous_acknowledgment_number + 1) & sequence_mask))
+                if packet is not None:
+                    sock.sendto(packet, address)
 
-        return packets
+        return writer
 
 
 # Description
@@ -399,10 +2088,18 @@ def stop_and_wait(sock, address, sequence_number, acknowledgment_number, flags,
 #   packets: The packets to send (if we are the client) or None (if we are the server)
 #   sliding_window: The sliding window size to use
 #   skip_a_packet: Whether to skip a packet or not
+#   writer: The FileWriter to write the received data to (if we are the server)
+#   rtt: The RttEstimator to use for the retransmission timeout (if we are the client)
+#   congestion: The CongestionControl that decides how many packets can be in flight (if we are the client)
+#   window_scale: The shift of the window in the acks of the server, from the handshake (if we are the client)
+#   pacer: The Pacer that spreads the packets out in time, or None to send them back to back (if we are the client)
+#   acks: The DelayedAcks that sends the acks, and holds back acks for packets in order (if we are the server)
+#   legacy: Whether the client sent no options in its SYN, i.e. it is an older client (if we are the server)
 # Returns
-#   sock: The socket to use or the packets received (if we are the server)
+#   sock: The socket to use or the writer with the received data (if we are the server)
 def GBN(sock, address, sequence_number, acknowledgment_number, flags, receiver_window, packets=None,
-        sliding_window=5, skip_a_packet=False):
+        sliding_window=5, skip_a_packet=False, writer=None, rtt=None, congestion=None, window_scale=0,
+        pacer=None, acks=None, legacy=False):
     print("Using GBN")
 
     # Test case to skip a packet
@@ -415,118 +2112,215 @@ def GBN(sock, address, sequence_number, acknowledgment_number, flags, receiver_w
 
     # We are the client
     if packets is not None:
-        # Set the socket timeout to 500 ms
-        sock_timeout = 0.5
-        # Set the new socket timeout
-        sock.settimeout(sock_timeout)
-        # Set the last sequence number we received
+        # The time each packet in the window was first sent, and the packets that have been sent more than once.
+        # Karn's rule: only packets that were sent once give an RTT sample. They are kept in rings with one slot for
+        # each packet the window can hold, packet number i uses slot i % ring_size, and sent_packets tells which packet
+        # is in the slot
+        ring_size = sliding_window
+        sent_packets = [-1] * ring_size
+        sent_times = [0.0] * ring_size
+        retransmitted = bytearray(ring_size)
+        first_sequence_number = sequence_number
+        # Set the last sequence number we received, the start of the first packet that is not acked
         last_sequence = sequence_number
         # Set the last acknowledgment number we received
         last_acknowledgement = acknowledgment_number
         # Expected ack
         expected_ack = sequence_number + len(packets[0])
-        seq_archive = [0] * len(packets)
-        # Total acks received
+        # Total acks received, the number of the first packet that is not acked
         ack_count = 0
-        # Set the first sequence number
-        first_seq = sequence_number
+        # The next packet to send. Packets are sent once when the window opens for them, and only sent again after a
+        # timeout (go back to ack_count) or a fast retransmit
+        next_packet = 0
+        # GBN has one timer, for the first packet that is not acked. It is started again when the window moves
+        deadline = None
+        # Duplicate acks for the first packet in the window. The server repeats its last ack when a packet arrives out
+        # of order, so three of them mean that the packet was lost
+        duplicate_acks = 0
+        # The number of packets the server has room for, from the window in its last ack. Until the first ack the
+        # congestion control decides alone
+        packet_size = receiver_window - header_length
+        flow_window = sliding_window
+        # Send the packets of a window with one system call, and receive all waiting acks with one system call
+        batch = BatchIO(sock, address, sliding_window, receiver_window)
+        # Tail loss probe: when all the packets are sent, no more duplicate acks come to show that the last packets
+        # were lost. If nothing has been sent or acked for a probe timeout, we go back to the first packet that is not
+        # acked like a timeout, but without the backoff. The server drops the packets after a hole, so sending only
+        # the last packet (RFC 8985) would not repair it. It is done once until the window moves
+        last_activity = time.monotonic()
+        probed = False
+        tail_probes = 0
+        print(f"Packets to send {len(packets)}")
         while ack_count < len(packets):
-            print(f"Packets to send {len(packets)}")
-            # Send x packets
-            for i in range(ack_count, min(sliding_window + ack_count, len(packets))):
-                print(f"Sending package {i}")
-                if i == ack_count:
-                    # Set a new sequence number for the last acked packet
-                    sequence_number = last_sequence
-                    # Set a new acknowledgment number for the last acked packet
-                    acknowledgment_number = last_acknowledgement
+            # Send the packets the window has opened up for
+            # The congestion control decides how many packets of the window are sent, up to sliding_window, and the
+            # server decides how many it has room for. At least one packet is sent, so we find out when it has room
+            # again
+            # With pacing, the packets are spread out, and we stop sending until the next packet is due
+            pacing_pause = 0
+            if pacer is not None:
+                pacer.update(min(congestion.window(), flow_window), rtt.srtt)
+            while next_packet < min(min(congestion.window(), flow_window) + ack_count, len(packets)):
+                if pacer is not None:
+                    pacing_pause = pacer.next_send(header_length + len(packets[next_packet]), batch)
+                    if pacing_pause:
+                        break
+                sequence_number = first_sequence_number + packets.offset(next_packet)
+                # Remember when the packet was first sent
+                slot = next_packet % ring_size
+                if sent_packets[slot] == next_packet:
+                    retransmitted[slot] = 1
                 else:
-                    sequence_number += len(packets[i])  # Set a new sequence number for the next packet
-                seq_archive[i] = sequence_number
-                # Create the header
-                packet = create_packet(sequence_number, acknowledgment_number, 0, receiver_window, packets[i])
-                # If we are testing, skip the last packet
+                    sent_packets[slot] = next_packet
+                    sent_times[slot] = time.monotonic()
+                    retransmitted[slot] = 0
+                if deadline is None:
+                    deadline = time.monotonic() + rtt.rto
+
+                # If we are testing, skip the packet. It is handled as sent and lost
                 if test_case_packet_counter == test_case_packet_skip and not test_case_done and skip_a_packet:
                     test_case_done = True
                     print(f"Skipped packet {test_case_packet_skip}")
-                    continue
+                else:
+                    # Add the packet to the batch
+                    batch.add(sequence_number, last_acknowledgement, 0, receiver_window, packets[next_packet])
+                    print(f"Sent: SEQ {sequence_number}, ACK {last_acknowledgement}, {flags}, {receiver_window}")
                 test_case_packet_counter += 1
-
-                # Send the packet
-                sock.sendto(packet, address)
-                print(f"Sent: SEQ {sequence_number}, ACK {acknowledgment_number}, {flags}, {receiver_window}")
-
-            print("Next ack: ", expected_ack)
-            print("\n")
-            try:
-                # Receive the ack
-                raw_data, address = sock.recvfrom(receiver_window)
-                # Decode the header
-                sequence_number, acknowledgment_number, flags, receiver_window, data = strip_packet(raw_data)
+                next_packet += 1
+                last_activity = time.monotonic()
+            # Send the new packets
+            batch.flush()
+
+            # Wait for acks until the timer expires, or until the next packet is due with pacing or the probe
+            wait = deadline - time.monotonic() if deadline is not None else pacing_pause
+            if pacing_pause:
+                wait = min(wait, pacing_pause)
+            probe_deadline = None
+            if next_packet == len(packets) and ack_count < next_packet and not probed:
+                probe_deadline = last_activity + rtt.probe_timeout()
+                wait = min(wait, probe_deadline - time.monotonic())
+            if not batch.wait(max(0, wait)):
+                now = time.monotonic()
+                if probe_deadline is not None and now >= probe_deadline and (deadline is None or now < deadline):
+                    print("Tail loss probe, going back to the first packet that is not acked")
+                    probed = True
+                    tail_probes += 1
+                    duplicate_acks = 0
+                    next_packet = ack_count
+                    continue
+                if deadline is None or now < deadline:
+                    continue
+                print("Timeout, going back to the first packet that is not acked")
+                # Double the retransmission timeout, and go back to the first packet that is not acked
+                rtt.backoff()
+                congestion.on_timeout()
+                duplicate_acks = 0
+                next_packet = ack_count
+                deadline = None
+                continue
+
+            # Receive all the acks that are waiting in the socket
+            for sequence_number, acknowledgment_number, flags, advertised_window, data in batch.receive():
                 # Parse the flags
                 syn, ack, fin, rst = parse_flags(flags)
-                print(f"Received: SEQ {sequence_number}, ACK {acknowledgment_number}, {flags}, {receiver_window}")
+                print(f"Received: SEQ {sequence_number}, ACK {acknowledgment_number}, {flags}, {advertised_window}")
+                # A SYN ACK that the server sent again for a SYN that was sent again is not an ack of our data
+                if not ack or syn:
+                    continue
+                # Extend the 32 bit ack to the full sequence number, from the first byte that is not acked
+                acknowledgment_number = unwrap_sequence(acknowledgment_number, last_sequence)
+                # The free space of the server in bytes, from the first byte it has not acked
+                flow_window = max(1, (advertised_window << window_scale) // packet_size)
+
+                # Fast retransmit: go back to the first packet in the window after three duplicate acks, without
+                # waiting for the timeout. The server drops the packets after a hole, so they are all sent again.
+                # More duplicate acks are ignored until the window moves (fast recovery)
+                # The empty packet at the end has the same ack as the packet before it, so it is not a duplicate
+                if acknowledgment_number == last_sequence and ack_count < next_packet \
+                        and acknowledgment_number < expected_ack:
+                    duplicate_acks += 1
+                    if duplicate_acks == 3:
+                        print(f"Three duplicate acks, fast retransmit from SEQ {last_sequence}")
+                        congestion.on_loss()
+                        next_packet = ack_count
+                        deadline = None
+                    continue
 
-                # If the ack is correct, update the ack count
-                if ack and acknowledgment_number >= expected_ack:
+                # If the ack is correct, update the ack count. The ack is cumulative, so it can acknowledge more
+                # than one packet if an earlier ack was lost
+                rtt_sample = None
+                acked_packets = 0
+                while acknowledgment_number >= expected_ack and ack_count < next_packet:
                     # Update the last sequence number and last ack number
                     last_sequence = expected_ack
                     last_acknowledgement = sequence_number
+                    # Take an RTT sample if the packet acked by this ack was only sent once
+                    slot = ack_count % ring_size
+                    if acknowledgment_number == expected_ack and sent_packets[slot] == ack_count \
+                            and not retransmitted[slot]:
+                        rtt_sample = time.monotonic() - sent_times[slot]
+                        rtt.update(rtt_sample)
+                    acked_packets += 1
                     # Update the ack count
                     ack_count += 1
-                    # Update the expected ack
-                    expected_ack = expected_ack + len(packets[ack_count])
-
-                print(f"ack_count: {ack_count}")
-            except TimeoutError as e:
-                print(f"Timeout: {e}")
-                # Set the socket timeout to 500 ms
-                sock.settimeout(sock_timeout)
-                # Count the acks we have received
-                temp_seq = first_seq
-                ack_count = 0
-                for i in range(ack_count, len(packets)):
-                    if last_sequence == temp_seq:
-                        last_sequence = temp_seq + len(
-                            packets[i])  # Set a new sequence number for the last acked packet
-                        expected_ack = last_sequence + len(packets[i])  # Update the expected ack
-                        sequence_number = last_sequence  # Set a new sequence number for the last acked packet
-                        break
-                    temp_seq += len(packets[i])  # Set a new sequence number for the next packet
-                    ack_count += 1  # Update the ack count
-                ack_count += 1
-
+                    # Update the expected ack, if there are more packets to send
+                    if ack_count < len(packets):
+                        expected_ack = expected_ack + len(packets[ack_count])
+                if acked_packets:
+                    duplicate_acks = 0
+                    last_activity = time.monotonic()
+                    probed = False
+                    # Start the timer again for the next packet that is not acked, or stop it if all are acked
+                    deadline = time.monotonic() + rtt.rto if ack_count < next_packet else None
+                    # Let the congestion control grow the window
+                    congestion.on_ack(acked_packets, rtt_sample)
+            print(f"ack_count: {ack_count}")
+
+        print(f"System calls saved by batching: {batch.syscalls_saved}")
+        print(f"Congestion window at the end: {congestion.window()} packets")
+        if pacer is not None:
+            pacer.report()
+        print(f"Tail loss probes: {tail_probes}")
         return sock
     else:
         # Receive the first packet
-        packets = []  # List of packets
-        first_sequence_number = sequence_number  # The first sequence number
-        prev_sequence_number = sequence_number  # The previous sequence number
+        expected_sequence_number = sequence_number  # The sequence number of the next packet in order
+        previous_sequence_number = None  # The sequence number of the last packet in order
 
         # Start receiving packets
         while True:
-            # Receive a packet from a client
-            raw_data, address = sock.recvfrom(receiver_window)
-            # Decode the header
-            sequence_number, acknowledgment_number, flags, receiver_window, data = strip_packet(raw_data)
+            # Send the ack that is held back if its time is up before the next packet arrives
+            acks.wait(writer)
+            # Receive a packet from the client, the writer decides where the data is received to
+            sequence_number, acknowledgment_number, flags, receiver_window, data, address = writer.receive(sock)
             # Parse the flags
             syn, ack, fin, rst = parse_flags(flags)
             print(f"Received: SEQ {sequence_number}, ACK {acknowledgment_number}, {flags}, {receiver_window}")
             if fin:  # If we have received the last packet, exit the loop
                 break
+            acks.received()
 
-            print(f"Expecting : {prev_sequence_number + len(data)}")
+            print(f"Expecting : {expected_sequence_number}")
+            # Extend the 32 bit sequence number to the full sequence number, it wraps around for large files
+            sequence_number = unwrap_sequence(sequence_number, expected_sequence_number)
 
-            # If the sequence number is correct, add the data to the packet array, and send an ack.
-            if sequence_number == first_sequence_number or sequence_number == prev_sequence_number + len(data):
+            # An older client numbers a packet from the start of the previous packet plus its own length, so the
+            # short packet at the end and the empty packet after it start inside the previous packet
+            if legacy and previous_sequence_number is not None:
+                in_order = sequence_number == previous_sequence_number + len(data)
+            else:
+                in_order = sequence_number == expected_sequence_number
+
+            # If the sequence number is the next in order, write the data and send an ack.
+            # If the writer queue is full the packet is dropped, and the client will send it again
+            if in_order and writer.write(data):
                 # Update the sequence numbers
-                prev_sequence_number = sequence_number
+                previous_sequence_number = sequence_number
                 next_sequence_number = sequence_number + len(data)
+                expected_sequence_number = next_sequence_number
                 print("Data len " + str(len(data)))
                 # Increment the sequence number
                 sequence_number = acknowledgment_number + 1
-                # Add the data to the packets array
-                packets.append(data)
 
                 # If we are testing, skip the last packet
                 if test_case_packet_counter == test_case_packet_skip and not test_case_done and skip_a_packet:
@@ -535,14 +2329,35 @@ def GBN(sock, address, sequence_number, acknowledgment_number, flags, receiver_w
                     continue
                 test_case_packet_counter += 1
 
-                # Send the ack to the client
-                sock.sendto(
-                    encode_header(sequence_number, next_sequence_number, set_flags(0, 1, 0, 0), receiver_window),
-                    address)
-            else:
+                # Send the ack to the client, with the room the writer has as the window. It can be held back and
+                # sent for the next packets too
+                acks.send(
+                    encode_header(sequence_number, next_sequence_number, set_flags(0, 1, 0, 0),
+                                  writer.advertised_window()),
+                    address, True)
+            elif legacy:
+                # An older client counts every ack as one more packet acked, and only gets acks for packets in order.
+                # It sends the packets after the last ack again when it times out
                 print("Duplicate")
+            elif sequence_number > expected_sequence_number:
+                # The packet is out of order, a packet before it is missing. Ack the last byte we have in order again,
+                # so the client can see the loss from the duplicate acks
+                print("Out of order, sending duplicate ack")
+                acks.send(
+                    encode_header(acknowledgment_number + 1, expected_sequence_number, set_flags(0, 1, 0, 0),
+                                  writer.advertised_window()),
+                    address, False)
+            else:
+                # The ack for the packet was lost, ack the last byte we have in order again, or the client sends
+                # the packet again until it gives up
+                print("Duplicate, sending ack")
+                acks.send(
+                    encode_header(acknowledgment_number + 1, expected_sequence_number, set_flags(0, 1, 0, 0),
+                                  writer.advertised_window()),
+                    address, False)
 
-        return packets
+        acks.report()
+        return writer
 
 
 # Description
@@ -558,10 +2373,20 @@ def GBN(sock, address, sequence_number, acknowledgment_number, flags, receiver_w
 #   packets: The packets to send (if we are the client) or None (if we are the server)
 #   sliding_window: The sliding window size to use
 #   skip_a_packet: Whether to skip a packet or not
+#   writer: The FileWriter to write the received data to (if we are the server)
+#   rtt: The RttEstimator to use for the retransmission timeout (if we are the client)
+#   sack: Whether selective acknowledgements were agreed on in the handshake
+#   congestion: The CongestionControl that decides how many packets can be in flight (if we are the client)
+#   window_scale: The shift of the window in the acks of the server, from the handshake (if we are the client)
+#   pacer: The Pacer that spreads the packets out in time, or None to send them back to back (if we are the client)
+#   acks: The DelayedAcks that sends the acks, and holds back acks for packets in order (if we are the server)
+#   fec: The FecEncoder for the parity packets (if we are the client), or whether FEC was agreed on (if we are the
+#   server)
 # Returns
-#   sock: The socket to use or the packets received (if we are the server)
+#   sock: The socket to use or the writer with the received data (if we are the server)
 def SR(sock, address, sequence_number, acknowledgment_number, flags, receiver_window, packets=None,
-       sliding_window=5, skip_a_packet=False):
+       sliding_window=5, skip_a_packet=False, writer=None, rtt=None, sack=False, congestion=None, window_scale=0,
+       pacer=None, acks=None, fec=None):
     print("Using SR")
 
     # Test case to skip a packet
@@ -574,179 +2399,740 @@ def SR(sock, address, sequence_number, acknowledgment_number, flags, receiver_wi
 
     # We are the client
     if packets is not None:
-        # Set the socket timeout to 500 ms
-        sock_timeout = 0.5
-        # Set the new socket timeout
-        sock.settimeout(sock_timeout)
+        # The state of the packets in the window is kept in rings with one slot for each packet the window can hold.
+        # Packet number i uses slot i % ring_size. The window is bounded by the packets in flight, not by the first
+        # packet that is not acked, so acks for later packets let new packets out while a hole is being filled. The
+        # window can then span up to twice sliding_window packets, which is what the server buffers at least, so the
+        # packets in the window never share a slot. The sequence number of a packet and the packet an ack belongs to
+        # are calculated from the offset, so the memory used does not depend on the size of the file
+        ring_size = sliding_window * 2
+        first_sequence_number = sequence_number
+        # Every packet in the window has its own retransmission timer. The timers are kept in a min-heap of
+        # (deadline, packet number), so the next timer to expire is always first. A timer is cancelled by clearing its
+        # deadline in the deadlines ring, the old entry in the heap is skipped when it comes to the top
+        timers = []
+        deadlines = [None] * ring_size
+        # The time each packet in the window was first sent, and the packets that have been sent more than once.
+        # Karn's rule: only packets that were sent once give an RTT sample
+        sent_times = [0.0] * ring_size
+        retransmitted = bytearray(ring_size)
+        # The packets in the window that have been acked, the packets before the window are all acked
+        packets_acked = bytearray(ring_size)
+        # The highest packet that has been acked, and the holes that have been sent again because of SACK blocks.
+        # A packet is sent again when three packets after it have been acked, like three duplicate acks
+        highest_acked = -1
+        sack_retransmitted = bytearray(ring_size)
+        # The window is made smaller once for each window of packets, a loss found before the packets sent after the
+        # last reduction is part of the same congestion event
+        recovery_point = 0
+        # The number of packets the server has room for, from the window in its last ack. Until the first ack the
+        # congestion control decides alone
+        packet_size = receiver_window - header_length
+        flow_window = sliding_window
 
-        # Set the last sequence number we received
-        sequence_starting_point = sequence_number
-        # Set the last acknowledgment number we received
-        acknowledgement_starting_point = acknowledgment_number
+        print(f"Packet to send: {len(packets)}")
 
-        # Total acks received
-        ack_count = 0
+        # The first packet in the window that is not acked, and the next packet that has not been sent
+        starting_point = 0
+        next_packet = 0
+        # The packets that have been sent and not acked. Every ack takes packets out of flight and makes room for new
+        # packets at once, the congestion window limits this number
+        in_flight = 0
+        # Sequence number of the next packet that has not been sent
+        next_sequence_number = sequence_number
+        # Send the packets with one system call, and receive all waiting acks with one system call
+        batch = BatchIO(sock, address, sliding_window, receiver_window)
+        # Tail loss probe: when all the packets are sent, no more acks come to show that the last packets were lost.
+        # If nothing has been sent or acked for a probe timeout, the last packet that is not acked is sent again, once
+        # until the window moves, and its ack shows the holes before it (RFC 8985)
+        last_activity = time.monotonic()
+        probed = False
+        tail_probes = 0
+
+        while starting_point < len(packets):
+            now = time.monotonic()
+            # Send the new packets that fit in the window, and start their timers
+            # The congestion control decides how many packets can be in flight, up to sliding_window
+            # The server decides how many it has room for after the first packet it has not received, and the ring
+            # holds the rest of the window. At least one packet is sent, so we find out when the server has room
+            # With pacing, the new packets are spread out, and we stop sending until the next packet is due
+            pacing_pause = 0
+            if pacer is not None:
+                pacer.update(min(congestion.window(), flow_window), rtt.srtt)
+            while next_packet < len(packets) and in_flight < congestion.window() \
+                    and next_packet < starting_point + min(flow_window, ring_size):
+                if pacer is not None:
+                    pacing_pause = pacer.next_send(header_length + len(packets[next_packet]), batch)
+                    if pacing_pause:
+                        break
+                slot = next_packet % ring_size
+                packets_acked[slot] = 0
+                retransmitted[slot] = 0
+                sack_retransmitted[slot] = 0
+                sent_times[slot] = now
+                deadlines[slot] = now + rtt.rto
+                heapq.heappush(timers, (deadlines[slot], next_packet))
+
+                # If we are testing, skip the packet. The timer is started, so it is sent again when it expires
+                if test_case_packet_counter == test_case_packet_skip and not test_case_done and skip_a_packet is True:
+                    test_case_done = True
+                    print(f"Skipped packet {test_case_packet_skip}")
+                else:
+                    batch.add(next_sequence_number, acknowledgment_number, 0, receiver_window, packets[next_packet])
+                    print(f"Sent: SEQ {next_sequence_number}, ACK {acknowledgment_number}, {flags}, {receiver_window}")
+                test_case_packet_counter += 1
+                # Add the packet to the FEC block, and send the parity packets when the block is full or the last data
+                # packet has been sent. The empty packet at the end is not in a block
+                if fec is not None and next_packet < len(packets) - 1:
+                    fec.add(next_sequence_number, packets[next_packet])
+                    fec.flush(batch, next_packet == len(packets) - 2)
+
+                in_flight += 1
+                next_packet += 1
+                next_sequence_number = first_sequence_number + packets.offset(next_packet)
+                last_activity = now
+
+            # Send the packets with expired timers again, each with a new deadline
+            timed_out = False
+            while timers and timers[0][0] <= now:
+                deadline, i = heapq.heappop(timers)
+                slot = i % ring_size
+                # Skip timers that have been cancelled or restarted, and packets the window has moved past
+                if i < starting_point or deadlines[slot] != deadline:
+                    continue
+                if not timed_out:
+                    # Double the retransmission timeout once for the packets that expired together
+                    print(f"Timeout, resending from packet {i}")
+                    rtt.backoff()
+                    congestion.on_timeout()
+                    recovery_point = next_packet
+                    timed_out = True
+                retransmitted[slot] = 1
+                if fec is not None:
+                    fec.on_loss()
+                resend_sequence_number = first_sequence_number + packets.offset(i)
+                batch.add(resend_sequence_number, acknowledgment_number, 0, receiver_window, packets[i])
+                print(f"Resent: SEQ {resend_sequence_number}, ACK {acknowledgment_number}, {flags}, {receiver_window}")
+                deadlines[slot] = now + rtt.rto
+                heapq.heappush(timers, (deadlines[slot], i))
+
+            # Send the tail loss probe if the probe timeout has passed. The probe is the last packet with data that is
+            # not acked, the empty packet at the end is not in the SACK blocks
+            probe_deadline = None
+            if next_packet == len(packets) and starting_point < next_packet and not probed and not timed_out:
+                probe_deadline = last_activity + rtt.probe_timeout()
+                if now >= probe_deadline:
+                    probe_deadline = None
+                    probed = True
+                    tail_probes += 1
+                    i = next_packet - 1
+                    while i > starting_point and (packets_acked[i % ring_size] or len(packets[i]) == 0):
+                        i -= 1
+                    slot = i % ring_size
+                    print(f"Tail loss probe, resending packet {i}")
+                    retransmitted[slot] = 1
+                    resend_sequence_number = first_sequence_number + packets.offset(i)
+                    batch.add(resend_sequence_number, acknowledgment_number, 0, receiver_window, packets[i])
+                    deadlines[slot] = now + rtt.rto
+                    heapq.heappush(timers, (deadlines[slot], i))
+            batch.flush()
+
+            # Wait for acks until the next timer expires, or until the next packet is due with pacing or the probe
+            wait = timers[0][0] - time.monotonic() if timers else rtt.rto
+            if pacing_pause:
+                wait = min(wait, pacing_pause)
+            if probe_deadline is not None:
+                wait = min(wait, probe_deadline - time.monotonic())
+            if not batch.wait(max(0, wait)):
+                continue
+
+            # Receive all the acks that are waiting in the socket
+            for rev_sequence_number, rev_acknowledgment_number, rev_flags, rev_receiver_window, rev_data \
+                    in batch.receive():
+                # Parse the flags
+                syn, ack, fin, rst = parse_flags(rev_flags)
+                print(f"Received: SEQ {rev_sequence_number}, ACK {rev_acknowledgment_number}, {rev_flags}, "
+                      f"{rev_receiver_window}")
+                # A SYN ACK that the server sent again for a SYN that was sent again is not an ack of our data
+                if not ack or syn:
+                    continue
+                # The acknowledgment number of our packets is the sequence number of the server
+                acknowledgment_number = rev_sequence_number
+                # Extend the 32 bit numbers to full sequence numbers, all acks are for bytes we have sent
+                rev_acknowledgment_number = unwrap_sequence(rev_acknowledgment_number, next_sequence_number)
+                # The free space of the server in bytes, from the first byte it has not written
+                flow_window = max(1, (rev_receiver_window << window_scale) // packet_size)
+
+                # The packets acked by this ack, as a range of packet numbers
+                newly_acked = []
+                sack_data = decode_sack(rev_data, next_sequence_number) if sack else None
+                if sack_data is not None:
+                    cumulative_ack, blocks = sack_data
+                    # All packets that end before the cumulative ack are received. The empty packet at the end ends
+                    # where it starts, so it is acked when all the data is received
+                    end = min(next_packet, packets.packet_number(cumulative_ack - first_sequence_number) + 1)
+                    while end > starting_point and first_sequence_number + packets.offset(end) > cumulative_ack:
+                        end -= 1
+                    newly_acked.append((starting_point, end))
+                    # And the packets in the blocks
+                    for start, end in blocks:
+                        newly_acked.append((packets.packet_number(start - first_sequence_number),
+                                            packets.packet_number(end - first_sequence_number)))
+                else:
+                    # The packet that ends at the ack. The last packet is empty, so it has the same ack as the packet
+                    # before it, the first of them that is not acked is used
+                    i = packets.packet_number(rev_acknowledgment_number - first_sequence_number) - 1
+                    if (i < starting_point or packets_acked[i % ring_size]) and i + 1 < next_packet \
+                            and len(packets[i + 1]) == 0:
+                        i += 1
+                    newly_acked.append((i, i + 1))
+
+                rtt_sample = None
+                acked_packets = 0
+                for start, end in newly_acked:
+                    for i in range(max(start, starting_point), min(end, next_packet)):
+                        slot = i % ring_size
+                        if packets_acked[slot]:
+                            continue
+                        packets_acked[slot] = 1
+                        acked_packets += 1
+                        in_flight -= 1
+                        highest_acked = max(highest_acked, i)
+                        # Stop the timer of the packet
+                        deadlines[slot] = None
+                        # Take an RTT sample if the packet was only sent once
+                        if not retransmitted[slot]:
+                            rtt_sample = time.monotonic() - sent_times[slot]
+                            rtt.update(rtt_sample)
+                # Let the congestion control grow the window, and allow a new probe
+                if acked_packets:
+                    congestion.on_ack(acked_packets, rtt_sample)
+                    last_activity = time.monotonic()
+                    probed = False
+
+            # Move the window past the packets that are acked
+            while starting_point < next_packet and packets_acked[starting_point % ring_size]:
+                starting_point += 1
+
+            # Send the holes in the SACK blocks again without waiting for their timers, once for each hole
+            # When all the packets are sent, there are no more packets to ack after a hole, and a hole below the
+            # highest packet acked is sent again at once (early retransmit, RFC 5827)
+            if sack:
+                now = time.monotonic()
+                hole_limit = highest_acked if next_packet == len(packets) else highest_acked - 2
+                for i in range(starting_point, hole_limit):
+                    slot = i % ring_size
+                    if packets_acked[slot] or sack_retransmitted[slot]:
+                        continue
+                    # With FEC the hole is only sent again when three packets after its block have been acked, so the
+                    # server has had the parity packets of the block to rebuild it from
+                    if fec is not None and fec.parity_count \
+                            and min((i // fec.block_size + 1) * fec.block_size, len(packets) - 1) > hole_limit:
+                        continue
+                    print(f"Hole in SACK blocks, resending packet {i}")
+                    if i >= recovery_point:
+                        congestion.on_loss()
+                        recovery_point = next_packet
+                    sack_retransmitted[slot] = 1
+                    retransmitted[slot] = 1
+                    if fec is not None:
+                        fec.on_loss()
+                    batch.add(first_sequence_number + packets.offset(i), acknowledgment_number, 0, receiver_window,
+                              packets[i])
+                    deadlines[slot] = now + rtt.rto
+                    heapq.heappush(timers, (deadlines[slot], i))
+                batch.flush()
+
+        print(f"System calls saved by batching: {batch.syscalls_saved}")
+        print(f"Congestion window at the end: {congestion.window()} packets")
+        if pacer is not None:
+            pacer.report()
+        if fec is not None:
+            fec.report()
+        print(f"Tail loss probes: {tail_probes}")
+        return sock
+    else:
+        # We are the server
 
-        print(f"Packet to send: {len(packets)}")
+        # The packets are kept in a ring of slots, by packet number. Packet number n is in slot n % buffer_size, as long
+        # as it is less than buffer_size packets after the next packet to write. The received bitmap tells which slots
+        # hold a packet, so finding duplicates and writing the packets in order does not depend on the size of the file
+        # The client does not send more than the window we advertise after the first byte we have not written, so that
+        # is the most we buffer, while the writer is catching up
+        packet_size = receiver_window - header_length
+        buffer_size = max(sliding_window * 2, writer.window_limit // packet_size + 1)
+        slots = [None] * buffer_size  # The data of each packet
+        slot_sequence_numbers = [0] * buffer_size  # The sequence number of each packet
+        received = bytearray(buffer_size)  # 1 if the slot holds a packet
+        first_sequence_number = sequence_number  # The sequence number of the first packet
+        next_packet = 0  # The packet number of the next packet to write
+        highest_packet = -1  # The highest packet number received
+        expected_sequence_number = sequence_number  # The sequence number of the next packet to write
+        last_acknowledgment_number = acknowledgment_number  # The ack number of the last data packet
+        # With FEC the packets that are written stay in their slots until the slot is used again, the lost packets of
+        # a block are rebuilt from the parity packets and the other packets of the block
+        fec_decoder = FecDecoder(first_sequence_number, packet_size, slots, slot_sequence_numbers, received) \
+            if fec else None
+
+        # Without SACK the client takes an ack to be for one packet only, so every packet is acked
+        if not sack:
+            acks.every = 1
 
-        # The packets we have sent and received acks for
-        packets_sent_and_received = [False] * len(packets)
-        # The expected acks
-        expected_acks = [0] * len(packets)
+        # Start receiving packets
+        while True:
+            # Send the ack that is held back if its time is up before the next packet arrives
+            acks.wait(writer)
+            # Receive a packet from the client, the writer decides where the data is received to
+            sequence_number, acknowledgment_number, flags, receiver_window, data, address = writer.receive(sock)
+            # Parse the flags
+            syn, ack, fin, rst = parse_flags(flags)
+            print(
+                f"Received: SEQ {sequence_number}, ACK {acknowledgment_number}, {flags}, {receiver_window}")
 
-        # The starting point of the sliding window
-        starting_point = 0
-        # The total packets received
-        total_packets_received = 0
-        recived_packets = []
-
-        end_point = sliding_window + 1
-
-        #  ack_count + 1 != len(packets) - 1
-        while total_packets_received < len(packets):
-            print("Acked this interval: ", ack_count)
-            ack_count = 0
-            # Total packets sent, used to break out of the loop if we have sent all packets in the interval
-            packets_sent_in_interval = 0
-            sequence_number = sequence_starting_point  # Set a new sequence number for the last acked packet
-            acknowledgment_number = acknowledgement_starting_point  # Set a new acknowledgment number for the last acked packet
-
-            print("Starting point: ", starting_point)
-
-            # Send the packets in the interval
-            for i in range(starting_point, min(end_point, len(packets))):
-                # print("\n")
-                if packets_sent_and_received[i] is False:
-                    print(f"Sending number: {i + 1} av  {min(end_point, len(packets))}")
-                    # Create the header
-                    packet = create_packet(sequence_number, acknowledgment_number, 0, receiver_window, packets[i])
-
-                    # If we are testing, skip the last packet
-                    if test_case_packet_counter == test_case_packet_skip and not test_case_done and skip_a_packet is True:
-                        test_case_done = True
-                        print(f"Skipped packet {test_case_packet_skip}")
+            # If we have received the last packet, exit the loop
+            if fin:
+                break
+            # Extend the 32 bit sequence number to the full sequence number, it wraps around for large files
+            sequence_number = unwrap_sequence(sequence_number, expected_sequence_number)
+
+            # All packets are full except the last one with data, and the empty packet after it. Rounding up gives
+            # the empty packet its own number
+            packet_number = -((first_sequence_number - sequence_number) // packet_size)
+            slot = packet_number % buffer_size
+
+            parity = fec_decoder is not None and flags & flag_parity
+            if parity:
+                # A parity packet for the block that starts at packet_number, it is only acked if it rebuilt a packet
+                fec_decoder.add(packet_number, acknowledgment_number, receiver_window, data, next_packet)
+                new_packet = False
+            else:
+                acks.received()
+                # Packets before the next packet to write are written already, and packets in a slot that is taken are
+                # buffered already
+                new_packet = packet_number >= next_packet and not (packet_number < next_packet + buffer_size
+                                                                   and received[slot])
+            if parity:
+                print("Parity packet")
+            elif not new_packet:
+                print("Duplicate packet")
+            # If the packet is too far ahead it does not fit in the ring, and it is dropped without an ack. The client
+            # will send it again
+            elif packet_number >= next_packet + buffer_size:
+                print("Buffer full, dropping packet")
+                continue
+            else:
+                print("We have a new packet, adding to buffer")
+                slots[slot] = data
+                slot_sequence_numbers[slot] = sequence_number
+                received[slot] = 1
+                highest_packet = max(highest_packet, packet_number)
+
+            # Rebuild the lost packets of the block the packet is in, if we have its parity packets
+            rebuilt = fec_decoder.recover(packet_number, next_packet) if fec_decoder is not None else []
+            for rebuilt_packet, rebuilt_sequence_number, rebuilt_data in rebuilt:
+                rebuilt_slot = rebuilt_packet % buffer_size
+                if rebuilt_packet >= next_packet + buffer_size or received[rebuilt_slot]:
+                    continue
+                print(f"Rebuilt packet {rebuilt_packet} from the parity")
+                slots[rebuilt_slot] = writer.place(rebuilt_sequence_number, rebuilt_data)
+                slot_sequence_numbers[rebuilt_slot] = rebuilt_sequence_number
+                received[rebuilt_slot] = 1
+                highest_packet = max(highest_packet, rebuilt_packet)
+            if parity and not rebuilt:
+                continue
+
+            # The packet is in order if it is the next packet to write and there are no packets after it
+            in_order = new_packet and packet_number == next_packet and highest_packet == packet_number and not rebuilt
+
+            # Write the packets that are in order to the file, as long as the writer has room for them
+            slot = next_packet % buffer_size
+            while received[slot] and writer.write(slots[slot]):
+                expected_sequence_number += len(slots[slot])
+                if fec_decoder is None:
+                    slots[slot] = None
+                received[slot] = 0
+                next_packet += 1
+                slot = next_packet % buffer_size
+
+            next_acknowledgment_number = sequence_number + len(data)  # Increment the sequence number
+            # The ack field of a parity packet holds the FEC fields, the last ack number of the client is used
+            if not parity:
+                last_acknowledgment_number = acknowledgment_number
+            sequence_number = last_acknowledgment_number + 1  # Increment the sequence number
+            flags = set_flags(0, 1, 0, 0)  # Set the flags for ack
+
+            # Acknowledge the packet, also if it's a duplicate
+            if new_packet:
+                # If we are testing, skip the last packet
+                if test_case_packet_counter == test_case_packet_skip and not test_case_done and skip_a_packet is True:
+                    test_case_done = True
+                    print(f"Skipped packet {test_case_packet_skip}")
+                    continue
+                test_case_packet_counter += 1
+
+            # Advertise the room the writer has as the window
+            receiver_window = writer.advertised_window()
+            packet = encode_header(sequence_number, next_acknowledgment_number, flags, receiver_window)
+            # Tell the client which bytes we have in order, and which ranges we have after them
+            if sack:
+                blocks = []
+                for i in range(next_packet, highest_packet + 1):
+                    slot = i % buffer_size
+                    if not received[slot] or len(slots[slot]) == 0:
+                        continue
+                    start = slot_sequence_numbers[slot]
+                    end = start + len(slots[slot])
+                    if blocks and blocks[-1][1] == start:
+                        blocks[-1][1] = end
+                    elif len(blocks) < max_sack_blocks:
+                        blocks.append([start, end])
                     else:
-                        # Send the packet
-                        sock.sendto(packet, address)
+                        break
+                packet += encode_sack(expected_sequence_number, blocks)
+            # The ack for a packet in order that was written can be held back and sent for the next packets too
+            acks.send(packet, address, in_order and next_packet > packet_number)
+            print(f"Sent: SEQ {sequence_number}, ACK {next_acknowledgment_number}, {flags}, {receiver_window}")
 
-                    test_case_packet_counter += 1
-                    print(f"Sent: SEQ {sequence_number}, ACK {acknowledgment_number}, {flags}, {receiver_window}")
-                    packets_sent_in_interval += 1
+        acks.report()
+        return writer
 
-                sequence_number += len(packets[i])  # Set a new sequence number for the next packet
-                expected_acks[i] = sequence_number  # Set the expected ack for the next packet
 
-                # If we have sent all packets in the interval, break
-                if packets_sent_in_interval == sliding_window:
-                    break
+# Description
+#   This function implements the NAK protocol, either as a client or a server (depending on the parameters).
+#   The server does not ack the packets that arrive in order. It sends a negative acknowledgement (NAK) with the
+#   missing byte ranges when it sees a gap, and a cumulative checkpoint when the client asks for one with the poll
+#   flag (once per RTT, and when the window is full), for a window of packets in order, or when the ack delay runs
+#   out, so the client can move its window. The NAKs and checkpoints have the same format as the SACK acks, but the
+#   blocks are the ranges that are missing. On a clean path only the checkpoints are sent back.
+#   The client sends the missing packets again, and sends all packets that are not acked again if nothing is heard
+#   from the server for a retransmission timeout (i.e. the last packets were lost)
+# Parameters
+#   sock: The socket to use
+#   address: The address to send to or receive from
+#   sequence_number: The sequence number to start with from the handshake
+#   acknowledgment_number: The acknowledgment number to start with from the handshake
+#   flags: The flags to use from the handshake
+#   receiver_window: The receiver window to use from the handshake
+#   packets: The packets to send (if we are the client) or None (if we are the server)
+#   sliding_window: The sliding window size to use
+#   skip_a_packet: Whether to skip a packet or not
+#   writer: The FileWriter to write the received data to (if we are the server)
+#   rtt: The RttEstimator to use for the retransmission timeout (if we are the client)
+#   congestion: The CongestionControl that decides how many packets can be in flight (if we are the client)
+#   window_scale: The shift of the window in the acks of the server, from the handshake (if we are the client)
+#   pacer: The Pacer that spreads the packets out in time, or None to send them back to back (if we are the client)
+#   acks: The DelayedAcks that holds back the checkpoints, and sends the NAKs at once (if we are the server)
+# Returns
+#   sock: The socket to use or the writer with the received data (if we are the server)
+def NAK(sock, address, sequence_number, acknowledgment_number, flags, receiver_window, packets=None,
+        sliding_window=5, skip_a_packet=False, writer=None, rtt=None, congestion=None, window_scale=0,
+        pacer=None, acks=None):
+    print("Using NAK")
 
-                print("Packets sent in interval: ", packets_sent_in_interval)
-            while True:
-                try:
-                    # Receive the ack
-                    raw_data, address = sock.recvfrom(receiver_window)
-                    # Decode the header
-                    rev_sequence_number, rev_acknowledgment_number, rev_flags, rev_receiver_window, rev_data = strip_packet(
-                        raw_data)
-                    # Parse the flags
-                    syn, ack, fin, rst = parse_flags(flags)
-                    print(
-                        f"Received: SEQ {rev_sequence_number}, ACK {rev_acknowledgment_number}, {rev_flags}, {rev_receiver_window}")
-                    recived_packets.append(rev_data)
-
-                    for j in range(starting_point, len(packets)):
-                        if expected_acks[j] == 0:
-                            print("Expected ack is empty, breaking")
-                            break
-                        if ack and rev_acknowledgment_number == expected_acks[j] and packets_sent_and_received[
-                            j] is False:
-                            packets_sent_and_received[j] = True
-                            # Update the last sequence number and last ack number
-                            # Update the ack countk
-                            total_packets_received += 1
-                            ack_count += 1
-                            break
-
-                    if expected_acks[starting_point] and packets_sent_and_received[starting_point] is True:
-                        minimum_sequence_number = rev_sequence_number
-                        sequence_starting_point = rev_acknowledgment_number
-                        acknowledgement_starting_point = minimum_sequence_number
-                        starting_point += 1
-                        end_point += 1
-                        print("New starting point: ", starting_point)
-                        break
+    # Test case to skip a packet
+    test_case_packet_counter = 0
+    test_case_packet_skip = 9
+    test_case_done = False
+
+    # We are the client
+    if packets is not None:
+        # The state of the packets in the window is kept in rings with one slot for each packet the window can hold.
+        # Packet number i uses slot i % ring_size, the window is never larger than sliding_window
+        ring_size = sliding_window
+        first_sequence_number = sequence_number
+        # The time each packet in the window was first sent, and the packets that have been sent more than once.
+        # Karn's rule: only packets that were sent once give an RTT sample
+        sent_times = [0.0] * ring_size
+        retransmitted = bytearray(ring_size)
+        # When each packet was last sent again for a NAK. The server repeats the missing ranges in its next NAKs,
+        # a packet is only sent again for them when the last copy has had an RTT to arrive
+        resent_times = [0.0] * ring_size
+        # The window is made smaller once for each window of packets, a loss found before the packets sent after the
+        # last reduction is part of the same congestion event
+        recovery_point = 0
+        # One timer for the whole window, it is started again every time we hear from the server
+        deadline = None
+        # The checkpoints are asked for with the poll flag, once per RTT, so the number of checkpoints does not grow
+        # with the packets sent. The packet that fills the window also polls, so the window keeps moving when it is
+        # smaller than what can be sent in an RTT. The poll_packet is the first packet after the last window poll
+        last_poll_time = None
+        poll_packet = 0
+        # The number of packets the server has room for, from the window in its last checkpoint. Until the first
+        # checkpoint the congestion control decides alone
+        packet_size = receiver_window - header_length
+        flow_window = sliding_window
+
+        print(f"Packet to send: {len(packets)}")
 
-                except TimeoutError as e:
-                    print(f"Timeout: {e}")
-                    # Set the socket timeout to 500 ms
-                    sock.settimeout(sock_timeout)
+        # The first packet in the window that is not acked, and the next packet that has not been sent
+        starting_point = 0
+        next_packet = 0
+        # Sequence number of the next packet that has not been sent
+        next_sequence_number = sequence_number
+        # Send the packets with one system call, and receive all waiting NAKs with one system call
+        batch = BatchIO(sock, address, sliding_window, receiver_window)
+        # Tail loss probe: when all the packets are sent, no more packets come to the server to show it that the last
+        # packets were lost. If we have not sent anything or heard from the server for a probe timeout, the last packet
+        # is sent again with the poll flag, and the checkpoint it gets back has the missing ranges. It is done once
+        # until we hear from the server
+        last_activity = time.monotonic()
+        probed = False
+        tail_probes = 0
+
+        while starting_point < len(packets):
+            now = time.monotonic()
+            # Send the new packets that fit in the window
+            # The congestion control decides how many packets of the window are sent, up to sliding_window
+            # The server decides how many it has room for. At least one packet is sent, so we find out when it has room
+            # With pacing, the new packets are spread out, and we stop sending until the next packet is due
+            pacing_pause = 0
+            if pacer is not None:
+                pacer.update(min(congestion.window(), flow_window), rtt.srtt)
+            while next_packet < len(packets) and next_packet < starting_point + min(congestion.window(), flow_window):
+                if pacer is not None:
+                    pacing_pause = pacer.next_send(header_length + len(packets[next_packet]), batch)
+                    if pacing_pause:
+                        break
+                slot = next_packet % ring_size
+                retransmitted[slot] = 0
+                resent_times[slot] = 0.0
+                sent_times[slot] = now
+                if deadline is None:
+                    deadline = now + rtt.rto
+
+                packet_flags = 0
+                window_end = starting_point + min(congestion.window(), flow_window)
+                if last_poll_time is None or now - last_poll_time >= rtt.srtt \
+                        or (next_packet + 1 >= window_end and next_packet >= poll_packet):
+                    packet_flags = flag_poll
+                    last_poll_time = now
+                    poll_packet = window_end
+
+                # If we are testing, skip the packet. The server sends a NAK for it when the next packet arrives
+                if test_case_packet_counter == test_case_packet_skip and not test_case_done and skip_a_packet is True:
+                    test_case_done = True
+                    print(f"Skipped packet {test_case_packet_skip}")
+                else:
+                    batch.add(next_sequence_number, acknowledgment_number, packet_flags, receiver_window,
+                              packets[next_packet])
+                    print(f"Sent: SEQ {next_sequence_number}, ACK {acknowledgment_number}, {packet_flags}, "
+                          f"{receiver_window}")
+                test_case_packet_counter += 1
 
+                next_packet += 1
+                next_sequence_number = first_sequence_number + packets.offset(next_packet)
+                last_activity = now
+            batch.flush()
+
+            # Wait for NAKs and checkpoints until the timer expires, or until the next packet is due with pacing or
+            # the probe. The timer is stopped when all the packets sent are acked and pacing holds back the next one
+            wait = deadline - time.monotonic() if deadline is not None else pacing_pause
+            if pacing_pause:
+                wait = min(wait, pacing_pause)
+            probe_deadline = None
+            if next_packet == len(packets) and not probed:
+                probe_deadline = last_activity + rtt.probe_timeout()
+                wait = min(wait, probe_deadline - time.monotonic())
+            if not batch.wait(max(0, wait)):
+                now = time.monotonic()
+                if probe_deadline is not None and probe_deadline <= now and (deadline is None or now < deadline):
+                    probed = True
+                    tail_probes += 1
+                    i = next_packet - 1
+                    slot = i % ring_size
+                    print(f"Tail loss probe, resending packet {i}")
+                    retransmitted[slot] = 1
+                    batch.add(first_sequence_number + packets.offset(i), acknowledgment_number, flag_poll,
+                              receiver_window, packets[i])
+                    batch.flush()
+                    continue
+                if deadline is None or now < deadline:
+                    continue
+                # We have not heard from the server for a retransmission timeout, the last packets or the checkpoint
+                # were lost. Send all the packets that are not acked again, the server answers them at once
+                print(f"Timeout, resending from packet {starting_point}")
+                rtt.backoff()
+                congestion.on_timeout()
+                recovery_point = next_packet
+                now = time.monotonic()
+                for i in range(starting_point, next_packet):
+                    slot = i % ring_size
+                    retransmitted[slot] = 1
+                    resent_times[slot] = now
+                    resend_sequence_number = first_sequence_number + packets.offset(i)
+                    batch.add(resend_sequence_number, acknowledgment_number, 0, receiver_window, packets[i])
+                    print(f"Resent: SEQ {resend_sequence_number}, ACK {acknowledgment_number}, {flags}, "
+                          f"{receiver_window}")
+                batch.flush()
+                deadline = now + rtt.rto
+                continue
+
+            # Receive all the NAKs and checkpoints that are waiting in the socket
+            for rev_sequence_number, rev_acknowledgment_number, rev_flags, rev_receiver_window, rev_data \
+                    in batch.receive():
+                # Parse the flags
+                syn, ack, fin, rst = parse_flags(rev_flags)
+                print(f"Received: SEQ {rev_sequence_number}, ACK {rev_acknowledgment_number}, {rev_flags}, "
+                      f"{rev_receiver_window}")
+                nak = decode_sack(rev_data, next_sequence_number)
+                # A SYN ACK that the server sent again for a SYN that was sent again is not an ack of our data
+                if not ack or syn or nak is None:
+                    continue
+                # The acknowledgment number of our packets is the sequence number of the server
+                acknowledgment_number = rev_sequence_number
+                # The free space of the server in bytes, from the first byte it has not written
+                flow_window = max(1, (rev_receiver_window << window_scale) // packet_size)
+                cumulative_ack, missing = nak
+                now = time.monotonic()
+                # We heard from the server, start the timer again, and allow a new probe
+                deadline = now + rtt.rto
+                last_activity = now
+                probed = False
+
+                # All packets that end before the cumulative ack are received. The empty packet at the end ends
+                # where it starts, so it is acked when all the data is received
+                end = min(next_packet, packets.packet_number(cumulative_ack - first_sequence_number) + 1)
+                while end > starting_point and first_sequence_number + packets.offset(end) > cumulative_ack:
+                    end -= 1
+                if end > starting_point:
+                    # Take an RTT sample from the last packet acked, if it was only sent once
+                    rtt_sample = None
+                    slot = (end - 1) % ring_size
+                    if not retransmitted[slot]:
+                        rtt_sample = now - sent_times[slot]
+                        rtt.update(rtt_sample)
+                    # Let the congestion control grow the window, and move the window past the acked packets
+                    congestion.on_ack(end - starting_point, rtt_sample)
+                    starting_point = end
+
+                # Send the missing packets again
+                for start, stop in missing:
+                    for i in range(max(packets.packet_number(start - first_sequence_number), starting_point),
+                                   min(packets.packet_number(stop - first_sequence_number), next_packet)):
+                        slot = i % ring_size
+                        if now - resent_times[slot] < rtt.srtt:
+                            continue
+                        print(f"NAK, resending packet {i}")
+                        if i >= recovery_point:
+                            congestion.on_loss()
+                            recovery_point = next_packet
+                        retransmitted[slot] = 1
+                        resent_times[slot] = now
+                        batch.add(first_sequence_number + packets.offset(i), acknowledgment_number, 0,
+                                  receiver_window, packets[i])
+            batch.flush()
+            # Stop the timer if all the packets that have been sent are acked
+            if starting_point == next_packet:
+                deadline = None
+
+        print(f"System calls saved by batching: {batch.syscalls_saved}")
+        print(f"Congestion window at the end: {congestion.window()} packets")
+        if pacer is not None:
+            pacer.report()
+        print(f"Tail loss probes: {tail_probes}")
         return sock
     else:
         # We are the server
 
-        packets = []  # List of packets
-        packets_acked = []  # List of packets that have been acked
-        buffer = []  # Buffer to store packets that might be out of order
+        # The packets are kept in a ring of slots by packet number, like in SR
+        packet_size = receiver_window - header_length
+        buffer_size = max(sliding_window * 2, writer.window_limit // packet_size + 1)
+        slots = [None] * buffer_size  # The data of each packet
+        received = bytearray(buffer_size)  # 1 if the slot holds a packet
+        first_sequence_number = sequence_number  # The sequence number of the first packet
+        next_packet = 0  # The packet number of the next packet to write
+        highest_packet = -1  # The highest packet number received
+        expected_sequence_number = sequence_number  # The sequence number of the next packet to write
 
         # Start receiving packets
         while True:
-            # Receive ack from the client
-            raw_data, address = sock.recvfrom(receiver_window)
-            # Decode the header
-            sequence_number, acknowledgment_number, flags, receiver_window, data = strip_packet(raw_data)
+            # Send the checkpoint that is held back if its time is up before the next packet arrives
+            acks.wait(writer)
+            # Receive a packet from the client, the writer decides where the data is received to
+            sequence_number, acknowledgment_number, flags, receiver_window, data, address = writer.receive(sock)
             # Parse the flags
             syn, ack, fin, rst = parse_flags(flags)
-            print(
-                f"Received: SEQ {sequence_number}, ACK {acknowledgment_number}, {flags}, {receiver_window}")
-
-            #  If the size of the buffer is the same as the sliding window, we can sort the buffer with the packets
-            if len(buffer) == sliding_window or fin:  # If the buffer is full, or we have received the last packet
-                buffer.sort(key=lambda x: x[0])  # Sort the buffer by sequence number
-                for i in range(len(buffer)):  # Loop through the buffer
-                    if len(buffer[i][1]) > 0:  # If the packet is not empty
-                        packets.append(buffer[i][1])  # Add the packet to the packet list
-                buffer = []  # Empty the buffer
+            print(f"Received: SEQ {sequence_number}, ACK {acknowledgment_number}, {flags}, {receiver_window}")
 
             # If we have received the last packet, exit the loop
             if fin:
                 break
-
-            # Mark the packet as new
-            new_packet = True
-
-            # Check if the packet is a duplicate packet
-            for i in range(len(packets_acked)):
-                if sequence_number == packets_acked[i]:
-                    new_packet = False
-                    print("Duplicate packet")
-                    break
-                    # Acknowledge the packet if it's new
-            if new_packet:
+            acks.received()
+            # Extend the 32 bit sequence number to the full sequence number, it wraps around for large files
+            sequence_number = unwrap_sequence(sequence_number, expected_sequence_number)
+
+            # All packets are full except the last one with data, and the empty packet after it. Rounding up gives
+            # the empty packet its own number
+            packet_number = -((first_sequence_number - sequence_number) // packet_size)
+            slot = packet_number % buffer_size
+
+            # Packets before the next packet to write are written already, and packets in a slot that is taken are
+            # buffered already
+            new_packet = packet_number >= next_packet and not (packet_number < next_packet + buffer_size
+                                                               and received[slot])
+            # The checkpoint for a packet is held back if it follows the highest packet received. A packet after a new
+            # gap, a packet that fills a gap, a duplicate, a packet with the poll flag and the empty packet at the end
+            # are answered at once
+            in_order = new_packet and packet_number == highest_packet + 1 and len(data) > 0 and not flags & flag_poll
+            first_to_write = packet_number == next_packet
+            if not new_packet:
+                print("Duplicate packet")
+            # If the packet is too far ahead it does not fit in the ring, and it is dropped. The client will send it
+            # again
+            elif packet_number >= next_packet + buffer_size:
+                print("Buffer full, dropping packet")
+                continue
+            else:
                 print("We have a new packet, adding to buffer")
-                packets_acked.append(sequence_number)  # Add the packet to the list of packets that have been acked
-                buffer.append((sequence_number, data))  # Add the packet to the buffer
-                next_acknowledgment_number = sequence_number + len(data)  # Increment the sequence number
-                sequence_number = acknowledgment_number + 1  # Increment the sequence number
-                flags = set_flags(0, 1, 0, 0)  # Set the flags for ack
+                slots[slot] = data
+                received[slot] = 1
+                highest_packet = max(highest_packet, packet_number)
+
+            # Write the packets that are in order to the file, as long as the writer has room for them
+            slot = next_packet % buffer_size
+            while received[slot] and writer.write(slots[slot]):
+                expected_sequence_number += len(slots[slot])
+                slots[slot] = None
+                received[slot] = 0
+                next_packet += 1
+                slot = next_packet % buffer_size
+
+            sequence_number = acknowledgment_number + 1  # Increment the sequence number
+            flags = set_flags(0, 1, 0, 0)  # Set the flags for ack
 
-                # If we are testing, skip the last packet
+            if new_packet:
+                # If we are testing, skip the checkpoint for a packet
                 if test_case_packet_counter == test_case_packet_skip and not test_case_done and skip_a_packet is True:
                     test_case_done = True
                     print(f"Skipped packet {test_case_packet_skip}")
                     continue
                 test_case_packet_counter += 1
 
-                sock.sendto(encode_header(sequence_number, next_acknowledgment_number, flags, receiver_window), address)
-                print(f"Sent: SEQ {sequence_number}, ACK {next_acknowledgment_number}, {flags}, {receiver_window}")
-            else:
-                next_acknowledgment_number = sequence_number + len(data)  # Increment the sequence number
-                sequence_number = acknowledgment_number + 1  # Increment the sequence number
-                flags = set_flags(0, 1, 0, 0)  # Set the flags for ack
-                sock.sendto(encode_header(sequence_number, next_acknowledgment_number, flags, receiver_window), address)
-                print(f"Sent: SEQ {sequence_number}, ACK {next_acknowledgment_number}, {flags}, {receiver_window}")
+            # The ranges that are missing between the next packet to write and the highest packet received
+            missing = []
+            for i in range(next_packet, highest_packet):
+                if received[i % buffer_size]:
+                    continue
+                start = first_sequence_number + i * packet_size
+                if missing and missing[-1][1] == start:
+                    missing[-1][1] = start + packet_size
+                elif len(missing) < max_sack_blocks:
+                    missing.append([start, start + packet_size])
+                else:
+                    break
 
-        return packets
+            # Advertise the room the writer has as the window
+            receiver_window = writer.advertised_window()
+            packet = (encode_header(sequence_number, expected_sequence_number, flags, receiver_window)
+                      + encode_sack(expected_sequence_number, missing))
+            # The checkpoints carry the missing ranges too, in case a NAK was lost. If the writer had no room for the
+            # packet, the client is told at once
+            acks.send(packet, address, in_order and not (first_to_write and next_packet == packet_number))
+            print(f"Sent: SEQ {sequence_number}, ACK {expected_sequence_number}, {flags}, {receiver_window}, "
+                  f"missing {len(missing)} ranges")
+
+        acks.report()
+        return writer
 
 
 # Description:
@@ -757,11 +3143,15 @@ def SR(sock, address, sequence_number, acknowledgment_number, flags, receiver_wi
 # filename: The filename to read and send
 # reliability: The reliability of the connection
 # tc_netem: The netem testcases to run
-# sliding_window: The sliding window size
+# sliding_window: The sliding window size, the largest window the congestion control can use
 # skip_a_packet: Whether or not to skip a packet
+# congestion_control: The name of the congestion control algorithm, a key in congestion_controls
+# pacing: None, "rtt" to pace gbn, sr and nak from the window and the RTT, or the rate to pace them at in Mbps
+# fec: None, or the packets in a FEC block and the parity packets for each block (None to adapt them to the loss) for sr
 # Returns
 #   None
-def run_client(server_ip, server_port, filename, reliability, tc_netem, sliding_window, skip_a_packet):
+def run_client(server_ip, server_port, filename, reliability, tc_netem, sliding_window, skip_a_packet,
+               congestion_control="reno", pacing=None, fec=None):
     # Create the testcases if they are specified
     if tc_netem is not None:
         create_tc_netem_testcases(tc_netem)
@@ -777,14 +3167,35 @@ def run_client(server_ip, server_port, filename, reliability, tc_netem, sliding_
         # and https://www.rfc-editor.org/rfc/rfc1948 page 4
         address = (server_ip, server_port)
 
-        # Create a header with the syn flag set
-        packet = encode_header(sequence_number, 0, set_flags(1, 0, 0, 0), receiver_window)
-        start_time = time.time()
-        # Send the packet
+        # Get the size of the file
+        filesize = os.path.getsize(filename)
+        print(f"Filesize: {filesize}")
+
+        # Create a header with the syn flag set, and the options after it. The server uses our reliability mode and
+        # window, and the size of the file so it can preallocate it. We do not receive data, so our window is not
+        # scaled. FEC is only asked for if it is used, the server keeps the packets longer for it
+        client_options = {
+            option_reliability: option_byte_struct.pack(reliability_modes.index(reliability)),
+            option_window: option_int_struct.pack(sliding_window),
+            option_mss: option_short_struct.pack(default_mss),
+            option_window_scale: option_byte_struct.pack(0),
+            option_sack: b"",
+            option_file_size: option_long_struct.pack(filesize),
+        }
+        if fec is not None:
+            client_options[option_fec] = b""
+        packet = (encode_header(sequence_number, 0, set_flags(1, 0, 0, 0), receiver_window)
+                  + encode_options(client_options))
+        # The SYN is sent again with backoff if it or the SYN ACK is lost, and we give up if the server never answers
         while True:
-            sock.sendto(packet, address)
-            # Receive the response from the server
-            raw_data, address = sock.recvfrom(receiver_window)
+            start_time = time.monotonic()
+            # Send the packet and receive the response from the server
+            answer = send_until_answered(sock, address, packet, syn_timeout)
+            if answer is None:
+                print_error(f"No answer from the server after {max_control_retries + 1} SYNs")
+                sock.close()
+                exit(1)
+            raw_data, address, retries = answer
             # Parse the header
             sequence_number, acknowledgment_number, flags, receiver_window, data = strip_packet(raw_data)
             print(f"Received: SEQ {sequence_number}, ACK {acknowledgment_number}, {flags}, {receiver_window}")
@@ -796,8 +3207,36 @@ def run_client(server_ip, server_port, filename, reliability, tc_netem, sliding_
 
             # If we receive a syn and ack from the server, we can send an ack to the server
             if syn and ack:
-                estimated_rtt = time.time() - start_time
-                print(f"Roundtrip time: {estimated_rtt}")
+                # The RTT is only measured if the SYN was sent once. If it was sent again we can not tell which SYN
+                # the SYN ACK answers (Karn's rule), and the timeout starts from the initial RTO of RFC 6298
+                estimated_rtt = time.monotonic() - start_time if retries == 0 else None
+                if estimated_rtt is None:
+                    print("Roundtrip time: not measured, the SYN was sent again")
+                else:
+                    print(f"Roundtrip time: {estimated_rtt}")
+                # The server sends the options it accepts, a server without options sends nothing
+                server_options = decode_options(data)
+                sack = option_sack in server_options
+                print(f"SACK: {sack}")
+                # The windows in the acks of the server are shifted by its window scale
+                window_scale = min(option_value(server_options, option_window_scale, option_byte_struct, 0),
+                                   max_window_scale)
+                print(f"Window scale: {window_scale}")
+                # The packets are sized from the MSS the server accepts, up to the MSS we offered. The modes take the
+                # size of a packet with the header as the receiver window
+                mss = max(max_filename_length, min(option_value(server_options, option_mss, option_short_struct,
+                                                                default_mss), default_mss))
+                receiver_window = header_length + mss
+                print(f"MSS: {mss}")
+                # The parity packets are only sent if the server can rebuild packets from them, which needs SACK
+                use_fec = fec is not None and option_fec in server_options and sack
+                if fec is not None:
+                    print(f"FEC: {use_fec}")
+                # The timeouts wait for the acks the server holds back, a server without the option holds them back
+                # for the default time
+                ack_delay = option_value(server_options, option_ack_delay, option_int_struct,
+                                         int(default_ack_delay * 1000)) / 1000
+                print(f"Ack delay: {ack_delay * 1000:.0f} ms")
                 # Save the acknowledgment number
                 acknowledgment_number_prev = acknowledgment_number
                 # Increment the sequence number by 1 to acknowledge the syn and ack
@@ -810,57 +3249,56 @@ def run_client(server_ip, server_port, filename, reliability, tc_netem, sliding_
                 sock.sendto(packet, address)
                 break
 
-        # Get the size of the file
-        filesize = os.path.getsize(filename)
-        print(f"Filesize: {filesize}")
-
-        # Array to store the packets
-        packets = []
-
-        # The length of the header
-        header_length = 12
-        # Sending name of file
-        # packets.append(filename.encode())
-
-        # Encode the filename to bytes
-        encoded_filename = filename.encode()
-        # Pad the filename with null bytes to make it 32 bytes long
-        encoded_filename = encoded_filename.ljust(max_filename_length, b'\0')
-
-        first_packet = True
-
-        # Open the file and send it in chunks of 1024 bytes
-        with open(filename, 'rb') as f:
-            print(f"Reading from {filename}")
-            # Loop until the end of the file
-            while True:
-                if first_packet:
-                    # Add the filename to the first packet and read the first chunk of the file
-                    file_raw_data = encoded_filename + f.read(receiver_window - header_length - max_filename_length)
-                    first_packet = False
-                else:
-                    # Read the next chunk of the file
-                    file_raw_data = f.read(receiver_window - header_length)
-                packets.append(file_raw_data)
-                if not file_raw_data:
-                    break
+        # Open the file for reading lazily, the packets are read from the file when they are sent, so sending can
+        # start right after the handshake and only the packets in the window are kept in memory
+        print(f"Reading from {filename}")
+        packets = PacketReader(filename, receiver_window - header_length)
 
         print(f"Total packets to send {len(packets)}")
 
+        # The retransmission timeout is adapted to the measured RTT, starting from the RTT of the handshake if it was
+        # measured, and waits for the acks the server holds back
+        rtt = RttEstimator(estimated_rtt, ack_delay)
+        # The congestion control changes the number of packets in flight, with sliding_window as the upper bound
+        congestion = congestion_controls[congestion_control](sliding_window)
+        print(f"Congestion control: {congestion_control}")
+        # Pacing spreads the packets of gbn, sr and nak out in time, at a fixed rate or from the window and the RTT
+        pacer = None
+        if pacing is not None:
+            pacer = Pacer(receiver_window, None if pacing == "rtt" else pacing * 1000000 / 8)
+            print(f"Pacing: {pacing if pacing == 'rtt' else f'{pacing} Mbps'}")
+        # Forward error correction sends parity packets for every block of packets of sr, the server rebuilds lost
+        # packets from them without waiting for them to be sent again
+        fec_encoder = None
+        if use_fec and reliability == "sr":
+            fec_encoder = FecEncoder(*fec)
+            print(f"FEC: blocks of {fec[0]} packets, "
+                  f"{'adaptive' if fec[1] is None else fec[1]} parity packets per block")
+
         # Start the timer for the throughput
         start_time = time.time()
 
         # Send file with mode
         if reliability == "stop_and_wait":
             sock = stop_and_wait(sock, address, sequence_number, acknowledgment_number, flags, receiver_window, packets,
-                                 skip_a_packet)
+                                 skip_a_packet, rtt=rtt)
         elif reliability == "gbn":
             sock = GBN(sock, address, sequence_number, acknowledgment_number, flags, receiver_window, packets,
-                       sliding_window, skip_a_packet)
+                       sliding_window, skip_a_packet, rtt=rtt, congestion=congestion, window_scale=window_scale,
+                       pacer=pacer)
 
         elif reliability == "sr":
             sock = SR(sock, address, sequence_number, acknowledgment_number, flags, receiver_window, packets,
-                      sliding_window, skip_a_packet)
+                      sliding_window, skip_a_packet, rtt=rtt, sack=sack, congestion=congestion,
+                      window_scale=window_scale, pacer=pacer, fec=fec_encoder)
+
+        elif reliability == "nak":
+            sock = NAK(sock, address, sequence_number, acknowledgment_number, flags, receiver_window, packets,
+                       sliding_window, skip_a_packet, rtt=rtt, congestion=congestion, window_scale=window_scale,
+                       pacer=pacer)
+
+        # We are done reading the file
+        packets.close()
 
         # Stop the timer for the throughput
         elapsed_time = time.time() - start_time
@@ -884,12 +3322,18 @@ def run_client(server_ip, server_port, filename, reliability, tc_netem, sliding_
         # Start a two-way handshake to close the connection
         # Set the flag to FIN, which is the 3rd element
         packet = encode_header(sequence_number, acknowledgment_number, set_flags(0, 0, 1, 0), receiver_window)
-        sock.sendto(packet, address)
         print("FIN sent in the packet header!")
 
-        # Wait for the ACK from the server to finally close everything
+        # Wait for the ACK from the server to finally close everything. The FIN is sent again with backoff from the
+        # retransmission timeout if it or the FIN ACK is lost. All the data is acked, so if the server never answers
+        # the file is still complete, and we close the connection anyway
         while True:
-            raw_data, address = sock.recvfrom(receiver_window)
+            answer = send_until_answered(sock, address, packet, rtt.rto)
+            if answer is None:
+                print(f"No ACK for FIN after {max_control_retries + 1} FINs, closing the connection")
+                sock.close()
+                break
+            raw_data, address, retries = answer
             sequence_number, acknowledgment_number, flags, receiver_window, data = strip_packet(raw_data)
 
             # Parse the flags
@@ -904,7 +3348,6 @@ def run_client(server_ip, server_port, filename, reliability, tc_netem, sliding_
             else:
                 # If we receive a packet with the wrong flags, we send a fin again
                 packet = encode_header(sequence_number, acknowledgment_number, set_flags(0, 0, 1, 0), receiver_window)
-                sock.sendto(packet, address)
 
     except KeyboardInterrupt:
         print("Client shutting down")
@@ -921,13 +3364,16 @@ def run_client(server_ip, server_port, filename, reliability, tc_netem, sliding_
 #   server_ip: The IP to bind the server to
 #    server_port: The port to bind the server to
 #   path: The path to save the file to
-#   reliability: The reliability of the connection (stop_and_wait, gbn, sr)
+#   reliability: The reliability of the connection (stop_and_wait, gbn, sr, nak), if the client does not send it
 #   tc_netem: The netem testcases to be run (duplicate, loss, reorder, skip_ack, skip_seq)
-#   sliding_window: The sliding window size
+#   sliding_window: The sliding window size, if the client does not send it
 #   skip_a_packet: The packet to be skipped
+#   ack_every: The number of packets in order gbn and sr send one ack for
+#   ack_delay: The longest time in seconds gbn and sr hold back an ack
 # Returns:
 #   None
-def run_server(server_ip, server_port, path, reliability, tc_netem, sliding_window, skip_a_packet=None):
+def run_server(server_ip, server_port, path, reliability, tc_netem, sliding_window, skip_a_packet=None,
+               ack_every=default_ack_every, ack_delay=default_ack_delay):
     # Create the testcases if they are specified
     if tc_netem is not None:
         create_tc_netem_testcases(tc_netem)
@@ -936,17 +3382,37 @@ def run_server(server_ip, server_port, path, reliability, tc_netem, sliding_wind
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         sock.bind((server_ip, server_port))
         print(f"Server started on {server_port} with IP {server_ip}")
+        # Ask for a large receive buffer, the data that waits in it is limited by the window we advertise. Linux
+        # reports the double of what we get, half of it is for the bookkeeping of the datagrams
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, socket_receive_buffer)
+        window_limit = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) // 2
 
         # Keep track of the sequence number, acknowledgment number, flags and receiver window
         sequence_number, acknowledgment_number, flags, receiver_window = 0, 0, 0, 64
 
         # Variable to keep track of the previous sequence_number number
         sequence_number_prev = 0
+        # The size of the file, if the client sends it in the SYN packet
+        file_size = None
+        # Whether the client supports selective acknowledgements
+        sack = False
+        # The shift of the window in our acks, without the option the window is limited to the window field
+        window_scale = 0
+        # Whether the client sends parity packets, only sr with SACK can rebuild packets from them
+        fec = False
+        # The largest data in a packet, the client can ask for a smaller one
+        mss = default_mss
+        # Whether the client is an older client that sends no options
+        legacy = False
+        # The SYN ACK we sent and the sequence number of the first data packet of the client, a SYN that is sent again
+        # gets the same SYN ACK
+        syn_ack = None
+        client_sequence_number = None
 
         # Three-way handshake based on https://www.ietf.org/rfc/rfc793.txt page 31
         while True:
             # Receive the response
-            raw_data, address = sock.recvfrom(receiver_window)
+            raw_data, address = sock.recvfrom(receive_buffer_size)
 
             # Parse the header
             sequence_number, acknowledgment_number, flags, receiver_window, data = strip_packet(raw_data)
@@ -955,11 +3421,39 @@ def run_server(server_ip, server_port, path, reliability, tc_netem, sliding_wind
             print(f"Received: SEQ {sequence_number}, ACK {acknowledgment_number}, {flags}, {receiver_window}")
             pretty_flags(flags)
 
-            # Overwrite the receiver window to 1472 bytes
-            receiver_window = 1472
+            # The modes take the size of a packet with the header as the receiver window
+            receiver_window = header_length + mss
 
+            # The client sends the SYN again if our SYN ACK was lost, send the same SYN ACK again
+            if syn and syn_ack is not None and (sequence_number + 1) & sequence_mask == client_sequence_number:
+                print("Received the SYN again, sending the SYN ACK again")
+                sock.sendto(syn_ack, address)
             # Check if the syn flag is set
-            if syn:
+            elif syn:
+                # Get the options of the client, the options we do not know are not looked at
+                client_options = decode_options(data)
+                # Use the reliability mode and the window of the client, so only the client has to be told them
+                mode = option_value(client_options, option_reliability, option_byte_struct)
+                if mode is not None and mode < len(reliability_modes):
+                    if reliability is not None and reliability != reliability_modes[mode]:
+                        print(f"The client uses {reliability_modes[mode]}, not {reliability}")
+                    reliability = reliability_modes[mode]
+                # Get the size of the file, so it can be preallocated
+                file_size = option_value(client_options, option_file_size, option_long_struct)
+                if file_size is not None:
+                    print(f"Filesize: {file_size}")
+                # Accept the MSS of the client up to what fits in the receive buffer
+                mss = max(max_filename_length, min(option_value(client_options, option_mss, option_short_struct,
+                                                                default_mss), max_mss))
+                receiver_window = header_length + mss
+                # The buffers of SR and NAK are allocated from the window, so it is capped at the packets the receive
+                # buffer holds. The advertised window keeps the client from having more than that in flight anyway
+                client_window = option_value(client_options, option_window, option_int_struct, sliding_window)
+                sliding_window = max(1, min(client_window, window_limit // mss + 1))
+                print(f"Reliability: {reliability}, window: {sliding_window}")
+                sack = option_sack in client_options
+                window_scale = window_scale_for(window_limit) if option_window_scale in client_options else 0
+                fec = option_fec in client_options and sack and reliability == "sr"
                 # Increment the acknowledgment number by 1 to acknowledge the syn
                 acknowledgment_number = sequence_number + 1
                 # Random Initial Sequence Number
@@ -969,49 +3463,99 @@ def run_server(server_ip, server_port, path, reliability, tc_netem, sliding_wind
                 sequence_number_prev = sequence_number
                 # Flags for syn and ack
                 flags = set_flags(1, 1, 0, 0)
-                # Create a header with the syn and ack flags set
-                packet = encode_header(sequence_number, acknowledgment_number, flags, receiver_window)
-                print(f"Sending: SEQ {sequence_number}, ACK {acknowledgment_number}, {flags}, {receiver_window}")
+                # Create a header with the syn and ack flags set, and the options we accept. The window of the SYN ACK
+                # is our window in bytes, it is not scaled like in TCP
+                accepted_options = {option_mss: option_short_struct.pack(mss)}
+                # Tell the client how long we hold back an ack, so its timeouts wait for it. Stop and wait acks at once
+                held_back = 0 if reliability == "stop_and_wait" else round(ack_delay * 1000)
+                accepted_options[option_ack_delay] = option_int_struct.pack(held_back)
+                if window_scale:
+                    accepted_options[option_window_scale] = option_byte_struct.pack(window_scale)
+                if sack:
+                    accepted_options[option_sack] = b""
+                if fec:
+                    accepted_options[option_fec] = b""
+                advertised_window = min(window_limit, max_advertised_window)
+                legacy = not client_options
+                if legacy:
+                    # A client without options is an older client. It sizes its packets from the window of the SYN
+                    # ACK and does not read options, so it gets the packet size and no options, like before
+                    advertised_window = receiver_window
+                    accepted_options = {}
+                packet = (encode_header(sequence_number, acknowledgment_number, flags, advertised_window)
+                          + encode_options(accepted_options))
+                print(f"Sending: SEQ {sequence_number}, ACK {acknowledgment_number}, {flags}, {advertised_window}")
                 pretty_flags(flags)
                 # Send the packet
                 sock.sendto(packet, address)
-            # Check if the ack flag is set and if the acknowledgment number is equal to the previous sequence number + 1
-            elif ack and acknowledgment_number == sequence_number_prev + 1:
+                syn_ack = packet
+                client_sequence_number = acknowledgment_number & sequence_mask
+            # Check if the acknowledgment number is equal to the previous sequence number + 1. The client starts
+            # sending data when it gets the SYN ACK, so a data packet also establishes the connection if the ACK was
+            # lost. The data of that packet is dropped, the client sends it again
+            elif syn_ack is not None and not fin \
+                    and acknowledgment_number == (sequence_number_prev + 1) & sequence_mask:
+                if not ack:
+                    print("Received data before the ACK, the ACK was lost")
                 print("Connection established")
+                # The data of the client starts after its SYN
+                sequence_number = client_sequence_number
                 break
 
-        # Array to store the packets
-        packets = []
+        if reliability is None:
+            print_error("The client did not send its reliability mode, and it is not set with -r")
+            sock.close()
+            exit(1)
+
+        # Receive many packets with one system call, if the kernel supports receive offload
+        gro_receiver = enable_gro(sock) if has_recvmsg_into else None
+
+        if file_size and has_recvmsg_into:
+            # We know the size of the file, receive the data straight into a memory mapped file
+            writer = MappedFileWriter(path, file_size, sequence_number, gro_receiver, window_limit, window_scale)
+        else:
+            # Start the writer thread, the received data is written to the file while it arrives. The queue holds a
+            # few windows of packets, so the memory used does not depend on the size of the file
+            writer = FileWriter(path, receiver_window - header_length, max(4 * sliding_window, 64), gro_receiver,
+                                window_limit, window_scale, receiver_window if legacy else None)
+
+        # An older client counts the acks, every packet it sends must get an ack of its own
+        if legacy:
+            ack_every = 1
 
         # Start the timer
         start_time = time.time()
         # Send file with mode
         if reliability == "stop_and_wait":
-            packets = stop_and_wait(sock, address, sequence_number, acknowledgment_number, flags, receiver_window, None,
-                                    skip_a_packet)
+            stop_and_wait(sock, address, sequence_number, acknowledgment_number, flags, receiver_window, None,
+                          skip_a_packet, writer)
 
         elif reliability == "gbn":
-            packets = GBN(sock, address, sequence_number, acknowledgment_number, flags, receiver_window, None,
-                          sliding_window,
-                          skip_a_packet)
+            GBN(sock, address, sequence_number, acknowledgment_number, flags, receiver_window, None,
+                sliding_window,
+                skip_a_packet, writer, acks=DelayedAcks(sock, ack_every, ack_delay), legacy=legacy)
 
         elif reliability == "sr":
-            packets = SR(sock, address, sequence_number, acknowledgment_number, flags, receiver_window, None,
-                         sliding_window,
-                         skip_a_packet)
+            SR(sock, address, sequence_number, acknowledgment_number, flags, receiver_window, None,
+               sliding_window,
+               skip_a_packet, writer, sack=sack, acks=DelayedAcks(sock, ack_every, ack_delay), fec=fec)
+
+        elif reliability == "nak":
+            # The client asks for the checkpoints, the server only sends one by itself after a window of packets
+            NAK(sock, address, sequence_number, acknowledgment_number, flags, receiver_window, None,
+                sliding_window,
+                skip_a_packet, writer, acks=DelayedAcks(sock, sliding_window, ack_delay))
 
         elapsed_time = time.time() - start_time
 
-        # Close the connection
-        close_server_connection(sock, address, sequence_number, receiver_window)
+        # Answer the FIN of the client
+        fin_ack = close_server_connection(sock, address, sequence_number, receiver_window)
 
-        # Convert the array of packets to a file
-        file = b""
-        for packet in packets:
-            file += packet
+        # Wait for the writer to write the rest of the file to disk
+        filename = writer.close()
 
         # Calculate the throughput
-        throughput = (len(file) / elapsed_time) * 8
+        throughput = (writer.bytes_received / elapsed_time) * 8
         throughput_formatted = "{:.2f}".format(throughput)
 
         if throughput > 1000000:
@@ -1023,20 +3567,14 @@ def run_server(server_ip, server_port, path, reliability, tc_netem, sliding_wind
         else:
             print(f"Throughput: {float(throughput_formatted):.2f} bps")
 
-        # Decode the filename to bytes and remove the padding
-        filename = file[:max_filename_length]
-        # Remove the padding from the filename
-        filename = filename.decode().strip("\0'")
-        # Remove the filename from the file
-        file = file[max_filename_length:]
-
-        # Save the file and set the permissions to 777
-        save_path = os.path.join(os.getcwd(), path)
-        save_file = open(os.path.join(save_path, filename), 'wb')
-        save_file.write(file)
-        save_file.close()
-        # Change the permissions of the file to 777
-        subprocess.run(f"chmod 777 {save_path}/{filename}", shell=True)
+        # Set the permissions of the saved file to 777
+        if filename is not None:
+            save_path = os.path.join(os.getcwd(), path)
+            # Change the permissions of the file to 777
+            subprocess.run(f"chmod 777 {save_path}/{filename}", shell=True)
+
+        # The file is saved, wait for FINs that are sent again before closing the connection
+        linger_server_connection(sock, address, fin_ack)
 
     except KeyboardInterrupt:
         print("Server shutting down")
@@ -1077,6 +3615,65 @@ def main():
         # Return the integer if it is a positive number
         return integer
 
+    # Description:
+    #   Checks if the window is a positive integer up to max_window
+    # Parameters:
+    #   window: holds the window in packets
+    # Returns:
+    #   Returns the window (integer) if valid, else it will exit the program with an error message
+    def check_window(window):
+        window = check_positive_integer(window)
+        if window > max_window:
+            print_error(f"The window is too large, it must be from 1 upto {max_window} packets")
+            parser.print_help()
+            exit(1)  # Exit the program
+        return window
+
+    # Description:
+    #   Checks the pacing, it is 'rtt' or a positive rate in Mbps
+    # Parameters:
+    #   pacing: holds the pacing from the command line
+    # Returns:
+    #   Returns 'rtt' or the rate as a float if valid, else it will exit the program with an error message
+    def check_pacing(pacing):
+        if pacing == "rtt":
+            return pacing
+        # Default error message message
+        error_message = f"{pacing} is not a valid pacing, must be 'rtt' or a positive rate in Mbps"
+        try:
+            pacing = float(pacing)  # Try to cast to float
+            if not 0 < pacing < float("inf"):  # Check if it is a positive number
+                raise ValueError  # Raise error if it is not a positive number
+        except ValueError:  # Catch the error if it is not a positive number
+            print_error(error_message)  # Print using standard error message function
+            parser.print_help()
+            exit(1)  # Exit the program
+        return pacing
+
+    # Description:
+    #   Checks the FEC block, 'N:K' with N packets in a block and K parity packets for each block, or 'N:auto'
+    # Parameters:
+    #   fec: holds the FEC block from the command line
+    # Returns:
+    #   Returns a tuple with N and K, K is None for 'auto', else it will exit the program with an error message
+    def check_fec(fec):
+        # Default error message message
+        error_message = (f"{fec} is not a valid FEC block, must be N:K or N:auto with 1 <= N <= {max_fec_block} and "
+                         f"0 <= K <= N, K <= {max_fec_parity}")
+        try:
+            block_size, parity_count = fec.split(":")
+            block_size = int(block_size)  # Try to cast to integer
+            parity_count = None if parity_count == "auto" else int(parity_count)
+            if not 1 <= block_size <= max_fec_block:  # Check that the block fits in the parity packet
+                raise ValueError
+            if parity_count is not None and not 0 <= parity_count <= min(block_size, max_fec_parity):
+                raise ValueError
+        except ValueError:  # Catch the error if it is not two numbers or they are out of range
+            print_error(error_message)  # Print using standard error message function
+            parser.print_help()
+            exit(1)  # Exit the program
+        return block_size, parity_count
+
     # Description:
     #   Checks if an integer from and including 1024 and up to and including 65,535
     # Parameters:
@@ -1209,6 +3806,15 @@ def main():
     client_group = parser.add_argument_group('Client')  # Create a group for the client arguments, for the help text
     client_group.add_argument('-c', '--client', action="store_true", help="Run in client mode")
     client_group.add_argument('-f', '--file', type=check_file, help="Name of the file to send")
+    client_group.add_argument('-cc', '--congestion', type=str, choices=list(congestion_controls), default="reno",
+                              help="Choose the congestion control for gbn, sr and nak, -w is the largest window it can "
+                                   "use. Default %(default)s")
+    client_group.add_argument('-pa', '--pacing', type=check_pacing,
+                              help="Spread the packets of gbn, sr and nak out in time. 'rtt' sends the window over one "
+                                   "RTT, a number is a fixed rate in Mbps")
+    client_group.add_argument('-fec', '--fec', type=check_fec,
+                              help="Send parity packets for sr, so the server can rebuild lost packets. N:K sends K "
+                                   "parity packets for each block of N packets, N:auto adapts K to the loss")
 
     # Server only arguments
     server_group = parser.add_argument_group('Server')  # Create a group for the server arguments, for the help text
@@ -1216,16 +3822,25 @@ def main():
     server_group.add_argument('-sp', '--save_path', type=check_save_path, default=default_server_save_path,
                               help="Save path for the files. If the folder does not exist it will be created Default "
                                    "folder %(""default)s/")
+    server_group.add_argument('-ae', '--ack_every', type=check_positive_integer, default=default_ack_every,
+                              help="Send one ack for this many packets that arrive in order, for gbn and sr. 1 acks "
+                                   "every packet. Default %(default)s")
+    server_group.add_argument('-ad', '--ack_delay', type=check_positive_integer, default=int(default_ack_delay * 1000),
+                              help="The longest time in milliseconds an ack is held back, for gbn, sr and nak. "
+                                   "Default %(default)s")
 
     # Common arguments
     parser.add_argument('-i', '--ip', type=check_ipaddress, default=default_ip,
                         help="IP address to connect/bind to, in dotted decimal notation. Default %(default)s")
     parser.add_argument('-p', '--port', type=check_port, default=default_port,
                         help="Port to use, default %(default)s")
-    parser.add_argument('-r', '--reliability', type=str, choices=["stop_and_wait", "gbn", "sr"],
-                        help="Choose reliability mode, this must match must match the server/client reliability mode")
-    parser.add_argument('-w', '--window', type=check_positive_integer, default=5,
-                        help="Set the window size, default %(default)s packets per window")
+    parser.add_argument('-r', '--reliability', type=str, choices=reliability_modes,
+                        help="Choose reliability mode. The client sends it in the handshake and the server uses it, "
+                             "on the server it is only used for a client that does not send it")
+    parser.add_argument('-w', '--window', type=check_window, default=5,
+                        help="Set the window size, default %(default)s packets per window. On the client it is the "
+                             "largest window the congestion control can use. The client sends it in the handshake "
+                             "and the server uses it")
     parser.add_argument('-t', '--mode', type=str, choices=["loss", "skip_ack"],
                         help="Choose your a testcase, loss or skip_ack. Skip_ack will run on the server side only and loss will run on client")
     parser.add_argument('-tn', '--tnetem', type=str, choices=["duplicate", "loss", "reorder", "skip_ack", "skip_seq"],
@@ -1253,14 +3868,10 @@ def main():
             skip_a_packet = True
 
         # Run the client
-        run_client(args.ip, args.port, args.file, args.reliability, args.tnetem, args.window, skip_a_packet)
+        run_client(args.ip, args.port, args.file, args.reliability, args.tnetem, args.window, skip_a_packet,
+                   args.congestion, args.pacing, args.fec)
 
     elif args.server:
-        if args.reliability is None:
-            print_error("Server reliability mode is not set!")
-            parser.print_help()
-            exit(1)
-
         skip_a_packet = False
         if args.mode == "skip_ack":
             skip_a_packet = True
@@ -1270,7 +3881,7 @@ def main():
 
         # Run the server
         run_server(args.ip, args.port, args.save_path, args.reliability, args.tnetem, args.window,
-                   skip_a_packet)
+                   skip_a_packet, args.ack_every, args.ack_delay / 1000)
 
     else:
         print("Error, you must select server or client mode!")
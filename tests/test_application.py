@@ -0,0 +1,412 @@
+# Unit tests for the helpers of application.py that can be tested without a network, one group for each part of the
+# protocol. Run them from the root of the repository with: python -m pytest -q
+import os
+import socket
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import application  # noqa: E402
+
+
+# The offset of every packet, and back, for an empty file, a file shorter than the first packet, and files that fill
+# the last packet exactly. The packets are 100 bytes, the first one has 68 bytes of the file after the filename
+@pytest.mark.parametrize("file_size, packet_count", [(0, 2), (10, 2), (68, 2), (69, 3), (268, 4)])
+def test_packet_reader_offsets(tmp_path, monkeypatch, file_size, packet_count):
+    monkeypatch.chdir(tmp_path)
+    with open("f.bin", "wb") as f:
+        f.write(os.urandom(file_size))
+    packets = application.PacketReader("f.bin", 100)
+    try:
+        assert len(packets) == packet_count
+        end = application.max_filename_length + file_size
+        # The payloads are laid out one after another, and the last packet is the empty one at the end
+        assert sum(len(packets[i]) for i in range(packet_count)) == end
+        assert len(packets[packet_count - 1]) == 0
+        for i in range(packet_count):
+            assert packets.offset(i) == min(i * 100, end)
+            assert packets.packet_number(packets.offset(i)) == i
+        assert packets.offset(packet_count) == end
+        with pytest.raises(IndexError):
+            packets[packet_count]
+    finally:
+        packets.close()
+
+
+# The first sample sets the smoothed RTT and the variance to half of it, RTO = SRTT + 4 * RTTVAR
+def test_rtt_estimator_first_sample():
+    rtt = application.RttEstimator(0.1, ack_delay=0)
+    assert rtt.srtt == 0.1
+    assert rtt.rttvar == 0.05
+    assert rtt.rto == pytest.approx(0.3)
+
+
+# The next samples are smoothed with alpha = 1/8 and beta = 1/4, and the RTO never goes below min_rto
+def test_rtt_estimator_update():
+    rtt = application.RttEstimator(0.1, ack_delay=0)
+    rtt.update(0.2)
+    assert rtt.rttvar == pytest.approx(0.75 * 0.05 + 0.25 * 0.1)
+    assert rtt.srtt == pytest.approx(0.875 * 0.1 + 0.125 * 0.2)
+    rtt = application.RttEstimator(0.001, ack_delay=0)
+    assert rtt.rto == application.min_rto
+
+
+# A timeout doubles the RTO up to max_rto, and a new sample takes the backoff away
+def test_rtt_estimator_backoff():
+    rtt = application.RttEstimator(0.1, ack_delay=0)
+    rtt.backoff()
+    assert rtt.rto == pytest.approx(0.6)
+    rtt.backoff()
+    assert rtt.rto == pytest.approx(1.2)
+    for i in range(10):
+        rtt.backoff()
+    assert rtt.rto == application.max_rto
+    rtt.update(0.1)
+    assert rtt.rto < 1
+
+
+# Without an RTT from the handshake the timeout is the initial RTO, and the first sample sets the estimate
+def test_rtt_estimator_without_handshake_sample():
+    rtt = application.RttEstimator(None)
+    assert rtt.rto == pytest.approx(application.syn_timeout, abs=0.01)
+    rtt.update(0.02)
+    assert rtt.srtt == 0.02
+    assert rtt.rttvar == 0.01
+
+
+# The cumulative ack and the blocks come back as they were sent, also after the numbers wrapped in the header
+def test_sack_round_trip_across_wrap():
+    cumulative_ack = 2 ** 32 + 100
+    blocks = [(2 ** 32 + 3000, 2 ** 32 + 5000), (2 ** 32 + 6000, 2 ** 32 + 7000)]
+    data = application.encode_sack(cumulative_ack, blocks)
+    assert len(data) == application.SACK_struct.size + 2 * application.SACK_block_struct.size
+    assert application.decode_sack(data, 2 ** 32 - 500) == (cumulative_ack, blocks)
+
+
+# An ack without SACK data gives None, and a block that is cut off is left out
+def test_decode_sack_short_data():
+    assert application.decode_sack(b"", 0) is None
+    assert application.decode_sack(b"\x00\x01", 0) is None
+    data = application.encode_sack(10, [(20, 30)])
+    assert application.decode_sack(data[:-1], 0) == (10, [])
+    assert application.decode_sack(application.encode_sack(10, []), 0) == (10, [])
+
+
+# The fixed window is always the window given with -w
+def test_fixed_congestion_control():
+    congestion = application.CongestionControl(10)
+    congestion.on_loss()
+    congestion.on_timeout()
+    assert congestion.window() == 10
+
+
+# Reno grows by one packet for each ack in slow start and by one packet for each window after it, and never past -w
+def test_reno_growth():
+    congestion = application.RenoCongestionControl(100)
+    assert congestion.window() == application.initial_congestion_window
+    congestion.on_ack(6)
+    assert congestion.window() == 8
+    congestion.ssthresh = 8
+    congestion.on_ack(8)
+    assert congestion.window() == 8
+    assert 8.9 < congestion.cwnd < 9
+    congestion.on_ack(10000)
+    assert congestion.cwnd == 100
+
+
+# Reno halves the window on a loss, and starts from one packet after a timeout
+def test_reno_loss_and_timeout():
+    congestion = application.RenoCongestionControl(100)
+    congestion.on_ack(30)
+    congestion.on_loss()
+    assert congestion.window() == 16
+    assert congestion.ssthresh == 16
+    congestion.on_timeout()
+    assert congestion.window() == 1
+    assert congestion.ssthresh == 8
+
+
+# The delay based window grows while the RTT stays at the lowest RTT, and shrinks when packets queue up
+def test_delay_congestion_control():
+    congestion = application.DelayCongestionControl(100)
+    congestion.on_ack(2, 0.01)
+    assert congestion.window() == 4
+    # Three quarters of the RTT is queueing, so 3 of the 4 packets wait in queues, slow start ends
+    congestion.on_ack(1, 0.04)
+    assert congestion.ssthresh == 4
+    assert congestion.window() == 4
+    # With 4 * (1 - 0.01 / 0.05) = 3.2 packets queued, the window stays
+    congestion.on_ack(4, 0.05)
+    assert congestion.window() == 4
+    # With 10 * (1 - 0.01 / 0.1) = 9 packets queued, more than delay_beta, the window shrinks by one packet
+    congestion.cwnd = 10
+    congestion.on_ack(10, 0.1)
+    assert congestion.window() == 9
+    # Without queueing it grows by one packet for each window of acks
+    congestion.on_ack(9, 0.01)
+    assert congestion.window() == 10
+
+
+# The window scale is the smallest shift that makes the window fit in the 16 bit window field
+@pytest.mark.parametrize("max_window, window_scale", [
+    (0, 0),
+    (application.max_advertised_window, 0),
+    (application.max_advertised_window + 1, 1),
+    (2 ** 20, 5),
+    (2 ** 40, application.max_window_scale),
+])
+def test_window_scale_for(max_window, window_scale):
+    assert application.window_scale_for(max_window) == window_scale
+
+
+# The writer advertises the free space in its queue, up to the window limit and shifted by the window scale
+def test_file_writer_advertised_window(tmp_path):
+    writer = application.FileWriter(str(tmp_path), 1000, 40)
+    assert writer.advertised_window() == 40000
+    writer.close()
+    writer = application.FileWriter(str(tmp_path), 1000, 40, window_limit=30000)
+    assert writer.advertised_window() == 30000
+    writer.close()
+    window_scale = application.window_scale_for(2 ** 20)
+    writer = application.FileWriter(str(tmp_path), 1000, 2000, window_limit=2 ** 20, window_scale=window_scale)
+    assert writer.advertised_window() == 2 ** 20 >> window_scale
+    writer.close()
+    # An older client gets the fixed window
+    writer = application.FileWriter(str(tmp_path), 1000, 40, fixed_window=1472)
+    assert writer.advertised_window() == 1472
+    writer.close()
+
+
+# Numbers from the header are extended to the full number closest to the reference, also across 2^32
+@pytest.mark.parametrize("number, reference, expected", [
+    (100, 50, 100),
+    (5, 2 ** 32 - 10, 2 ** 32 + 5),
+    (2 ** 32 - 10, 2 ** 32 + 5, 2 ** 32 - 10),
+    (2 ** 32 - 1, 0, -1),
+    (7, 3 * 2 ** 32 + 2 ** 31 + 100, 4 * 2 ** 32 + 7),
+    (2 ** 32 + 5, 2 ** 32 + 1, 2 ** 32 + 5),
+])
+def test_unwrap_sequence(number, reference, expected):
+    assert application.unwrap_sequence(number, reference) == expected
+
+
+# Description:
+#   Class that stands in for time.monotonic, the time only moves when a test moves it
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+# The bucket starts full with pacing_burst packets, and the next packet waits for its tokens at the rate
+def test_pacer_delay(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(application.time, "monotonic", clock)
+    pacer = application.Pacer(1000, 1000000)
+    for i in range(application.pacing_burst):
+        assert pacer.delay(1000) == 0
+        pacer.consume(1000)
+    assert pacer.delay(1000) == pytest.approx(0.001)
+    clock.now += 0.0004
+    assert pacer.delay(1000) == pytest.approx(0.0006)
+    # The bucket does not fill past pacing_burst packets
+    clock.now += 10
+    assert pacer.tokens < 1000
+    pacer.delay(1000)
+    assert pacer.tokens == application.pacing_burst * 1000
+
+
+# The time between the packets sent is measured when the tokens are taken
+def test_pacer_consume_gaps(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(application.time, "monotonic", clock)
+    pacer = application.Pacer(1000, 1000000)
+    for gap in (0, 0.002, 0.001):
+        clock.now += gap
+        pacer.consume(1000)
+    assert pacer.gaps == 2
+    assert pacer.gap_min == pytest.approx(0.001)
+    assert pacer.gap_max == pytest.approx(0.002)
+    assert pacer.gap_total == pytest.approx(0.003)
+
+
+# Without a given rate the window is sent over a little less than one RTT
+def test_pacer_rate_from_window():
+    pacer = application.Pacer(1000)
+    pacer.update(10, 0.01)
+    assert pacer.rate == pytest.approx(application.pacing_gain * 10 * 1000 / 0.01)
+    pacer = application.Pacer(1000, 500)
+    pacer.update(10, 0.01)
+    assert pacer.rate == 500
+
+
+# Description:
+#   Class that stands in for the writer of the server, DelayedAcks.wait only looks at its GRO receiver
+class FakeWriter:
+    gro_receiver = None
+
+
+# Description:
+#   Receives the acks that were sent to the receiving socket, without waiting
+# Parameters:
+#   sock: holds the socket the acks were sent to
+# Returns:
+#   Returns a list with the acks
+def received_acks(sock):
+    acks = []
+    while True:
+        try:
+            acks.append(sock.recv(2048, socket.MSG_DONTWAIT))
+        except BlockingIOError:
+            return acks
+
+
+@pytest.fixture
+def sockets():
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(("127.0.0.1", 0))
+    yield sender, receiver
+    sender.close()
+    receiver.close()
+
+
+# One ack is sent for every N packets in order, the newest one
+def test_delayed_acks_every(sockets):
+    sender, receiver = sockets
+    address = receiver.getsockname()
+    acks = application.DelayedAcks(sender, 3, 10)
+    for i in range(5):
+        acks.received()
+        acks.send(b"ack %d" % i, address, True)
+    assert received_acks(receiver) == [b"ack 2"]
+    # An ack for a packet out of order is sent at once, and replaces the one that was held back
+    acks.send(b"dup", address, False)
+    assert received_acks(receiver) == [b"dup"]
+    assert acks.acks_sent == 2
+    assert acks.data_packets == 5
+
+
+# A held back ack is sent when its deadline has passed, also if no more packets arrive
+def test_delayed_acks_deadline(sockets):
+    sender, receiver = sockets
+    address = receiver.getsockname()
+    acks = application.DelayedAcks(sender, 4, 0.02)
+    acks.send(b"ack", address, True)
+    assert received_acks(receiver) == []
+    acks.wait(FakeWriter())
+    assert received_acks(receiver) == [b"ack"]
+    # Nothing is held back, so wait returns at once and sends nothing
+    acks.wait(FakeWriter())
+    acks.flush()
+    assert acks.acks_sent == 1
+
+
+# Description:
+#   Class that stands in for BatchIO, it keeps the packets the FecEncoder sends
+class FakeBatch:
+    def __init__(self):
+        self.packets = []
+
+    def add(self, sequence_number, acknowledgment_number, flags, window, data):
+        self.packets.append((sequence_number, acknowledgment_number, flags, window, bytes(data)))
+
+
+# The parity packets of a block rebuild one lost packet for each parity packet, also a shorter last packet
+def test_fec_round_trip():
+    packet_size = 100
+    first_sequence_number = 2 ** 32 - 250
+    payloads = [os.urandom(packet_size) for i in range(5)] + [os.urandom(37)]
+    encoder = application.FecEncoder(len(payloads), 2)
+    batch = FakeBatch()
+    for i, data in enumerate(payloads):
+        encoder.add(first_sequence_number + i * packet_size, data)
+    encoder.flush(batch, last=True)
+    assert len(batch.packets) == 2
+    assert all(flags == application.flag_parity for _, _, flags, _, _ in batch.packets)
+
+    # Packets 2 and 5 are lost, one covered by each parity packet
+    lost = {2, 5}
+    slots = [None] * 8
+    slot_sequence_numbers = [0] * 8
+    received = bytearray(8)
+    for i, data in enumerate(payloads):
+        if i not in lost:
+            slots[i] = data
+            slot_sequence_numbers[i] = first_sequence_number + i * packet_size
+            received[i] = 1
+    decoder = application.FecDecoder(first_sequence_number, packet_size, slots, slot_sequence_numbers, received)
+    for sequence_number, fields, flags, length, data in batch.packets:
+        decoder.add((sequence_number - first_sequence_number) // packet_size, fields, length, data, 0)
+    rebuilt = decoder.recover(0, 0)
+    assert sorted(rebuilt) == sorted((i, first_sequence_number + i * packet_size, payloads[i]) for i in lost)
+
+
+# Two lost packets under the same parity packet can not be rebuilt
+def test_fec_two_losses_in_one_parity():
+    payloads = [os.urandom(50) for i in range(4)]
+    encoder = application.FecEncoder(len(payloads), 1)
+    batch = FakeBatch()
+    for i, data in enumerate(payloads):
+        encoder.add(i * 50, data)
+    encoder.flush(batch)
+    slots = [payloads[0], None, None, payloads[3]]
+    received = bytearray([1, 0, 0, 1])
+    decoder = application.FecDecoder(0, 50, slots, [0, 50, 100, 150], received)
+    sequence_number, fields, flags, length, data = batch.packets[0]
+    decoder.add(0, fields, length, data, 0)
+    assert decoder.recover(0, 0) == []
+
+
+# The ack delay of the server is waited for in the probe timeout and in the RTO
+def test_rtt_estimator_ack_delay():
+    rtt = application.RttEstimator(0.1, ack_delay=0.05)
+    assert rtt.rto == pytest.approx(0.35)
+    assert rtt.probe_timeout() == pytest.approx(0.25)
+    rtt = application.RttEstimator(0.1, ack_delay=0)
+    assert rtt.probe_timeout() == pytest.approx(0.2)
+
+
+def test_options_round_trip():
+    options = {
+        application.option_reliability: application.option_byte_struct.pack(2),
+        application.option_window: application.option_int_struct.pack(2 ** 32 - 1),
+        application.option_sack: b"",
+        application.option_file_size: application.option_long_struct.pack(2 ** 40),
+    }
+    decoded = application.decode_options(application.encode_options(options))
+    assert decoded == options
+    assert application.option_value(decoded, application.option_window, application.option_int_struct) == 2 ** 32 - 1
+    assert application.option_value(decoded, application.option_file_size, application.option_long_struct) == 2 ** 40
+
+
+# Options of a type we do not know are skipped over, the ones after them are still read
+def test_unknown_options_are_skipped():
+    data = (application.encode_options({200: b"unknown option"})
+            + application.encode_options({application.option_mss: application.option_short_struct.pack(1000)}))
+    decoded = application.decode_options(data)
+    assert application.option_value(decoded, application.option_mss, application.option_short_struct) == 1000
+    assert application.option_value(decoded, application.option_window, application.option_int_struct, 5) == 5
+
+
+# The options stop at an entry that is cut off, the entries before it are kept
+@pytest.mark.parametrize("tail", [b"\x02", b"\x02\x04", b"\x02\x04\x00\x00"])
+def test_truncated_options(tail):
+    data = application.encode_options({application.option_reliability: b"\x01"}) + tail
+    assert application.decode_options(data) == {application.option_reliability: b"\x01"}
+
+
+# A value of the wrong length gives the default instead of an error
+def test_option_value_wrong_length():
+    options = {application.option_window: b"\x00\x05", application.option_mss: b""}
+    assert application.option_value(options, application.option_window, application.option_int_struct, 7) == 7
+    assert application.option_value(options, application.option_mss, application.option_short_struct) is None
+
+
+# The largest window the client can send fits in the window option
+def test_max_window_fits_in_option():
+    application.option_int_struct.pack(application.max_window)